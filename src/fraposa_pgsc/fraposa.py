@@ -8,6 +8,14 @@ import pandas as pd
 from pyplink import PyPlink
 from sklearn.neighbors import KNeighborsClassifier
 
+from fraposa_pgsc.refcache import (ReferenceCache, atomic_write, fingerprint_files, fingerprint_plink, load_array,
+                                   save_array)
+from fraposa_pgsc.genotypes import BLOCK_SIZE, PackedGenotypes, open_bed
+from fraposa_pgsc.memplan import STUDY_BLOCK_SIZE, STUDY_CHUNK_SIZE, MemoryPlan, plan_memory
+from fraposa_pgsc.pcsfile import OUTPUT_FORMATS, PcsWriter, load_pcs, pcs_ids
+from fraposa_pgsc.prefetch import prefetch
+from fraposa_pgsc.projstore import ProjectionStore, hash_samples
+from fraposa_pgsc.thinning import thin_variants
 from fraposa_pgsc.variants import MatchType, Variants
 
 matplotlib.use('Agg')
@@ -15,13 +23,20 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib.lines import Line2D
 import os.path
+import json
 import time
 from datetime import datetime
 import sys
 import logging
+from contextlib import nullcontext
 from sklearn.utils.extmath import randomized_svd
 from typing import Union
 
+# Study samples re-projected in float64 to check the accuracy of reduced precision, and the largest deviation of their
+# PC scores (in reference PC standard deviations) that doesn't trigger a warning
+PRECISION_CHECK_SAMPLES = 20
+PRECISION_TOLERANCE = 1e-3
+
 
 def create_logger(out_filepref='fraposa'):
     log = logging.getLogger()
@@ -57,12 +72,24 @@ def svd_online(U1, d1, V1, b, l=None):
     assert U1.shape[1] == k
     assert len(d1) == k
     assert(l <= k)
+    d2, R_Vt = _svd_online_core(U1, d1, b)
+    V_new = np.zeros((k+1, n+1))
+    V_new[:k, :n] = V1.transpose()
+    V_new[k, n] = 1
+    V2 = (R_Vt @ V_new).transpose()[:,:l]
+    return d2, V2
+
+
+def _svd_online_core(U1, d1, b):
+    ''' Singular values and right singular vectors of the (k+1) x (k+1) matrix R of the online SVD update.
+    The updated V is [[V1, 0], [0, 1]] @ R_Vt.T '''
+    k = len(d1)
     p = U1.shape[0]
     b = b.reshape((p,1)) # Make sure the new sample is a column vec
     b_tilde = b - U1 @ (U1.T @ b)
-    b_tilde = b_tilde / np.sqrt(sum(np.square(b_tilde)))
+    b_tilde = b_tilde / np.sqrt(np.sum(np.square(b_tilde)))
     R = np.concatenate((np.diag(d1), U1.transpose() @ b), axis = 1)
-    R_tail = np.concatenate((np.zeros((1,k)), b_tilde.transpose() @ b), axis = 1)
+    R_tail = np.concatenate((np.zeros((1,k), dtype=R.dtype), b_tilde.transpose() @ b), axis = 1)
     R = np.concatenate((R, R_tail), axis = 0)
     d2, R_Vt = np.linalg.svd(R, full_matrices=False)[1:]
     # TODO: Try using chomsky decomposition on R to speed up
@@ -70,11 +97,25 @@ def svd_online(U1, d1, V1, b, l=None):
     # Eigencomposition's runtime is the same as svd's
     # d2, R_V = svd_eigcov(R.T @ R)
     # R_Vt = R_V.T
-    V_new = np.zeros((k+1, n+1))
-    V_new[:k, :n] = V1.transpose()
-    V_new[k, n] = 1
-    V2 = (R_Vt @ V_new).transpose()[:,:l]
-    return d2, V2
+    return d2, R_Vt
+
+
+def svd_update(U1, d1, V1, A, B, l=None):
+    ''' Thin SVD of U1 @ diag(d1) @ V1.T + A @ B.T, truncated to the top l components '''
+    k = len(d1)
+    if l is None:
+        l = k
+    A = A.reshape((U1.shape[0], -1))
+    B = B.reshape((V1.shape[0], -1))
+    r = A.shape[1]
+    assert B.shape[1] == r
+    Q_left, R_left = np.linalg.qr(np.hstack((U1, A)))
+    Q_right, R_right = np.linalg.qr(np.hstack((V1, B)))
+    K = R_left @ np.diag(np.concatenate((d1, np.ones(r)))) @ R_right.T
+    K_U, d2, K_Vt = np.linalg.svd(K, full_matrices=False)
+    U2 = Q_left @ K_U[:, :l]
+    V2 = Q_right @ K_Vt[:l].T
+    return U2, d2[:l], V2
 
 
 def procrustes(Y_mat, X_mat, return_transformed=False):
@@ -130,36 +171,76 @@ def procrustes_diffdim(Y_mat, X_mat, n_iter_max=10000, epsilon_min=1e-6, return_
             return R, rho, c
 
 
-def read_bed(bed_filepref, dtype=np.int8, filt_iid=None):
+def procrustes_gram(H, C_Y, C_X):
+    ''' procrustes for Y = F @ C_Y and X = F @ C_X, given the Gram matrix H = F.T @ F of a basis F whose last
+    column is all ones. Costs O(dim(F)^2) instead of O(rows of F) '''
+    n = H[-1, -1]
+    X_mean = H[-1] @ C_X / n
+    Y_mean = H[-1] @ C_Y / n
+    C = C_Y.T @ H @ C_X - n * np.outer(Y_mean, X_mean)
+    U, s, VT = np.linalg.svd(C, full_matrices=False)
+    trXX = np.sum(C_X * (H @ C_X)) - n * X_mean @ X_mean
+    trS = np.sum(s)
+    R = VT.T @ U.T
+    rho = trS / trXX
+    c = Y_mean - rho * X_mean @ R
+    return R, rho, c
+
+
+def procrustes_diffdim_gram(H, C_Y, C_X, n_iter_max=10000, epsilon_min=1e-6):
+    ''' procrustes_diffdim in the coordinates of procrustes_gram '''
+    p_X = C_X.shape[1]
+    p_Y = C_Y.shape[1]
+    assert p_X >= p_Y
+    if p_X == p_Y:
+        return procrustes_gram(H, C_Y, C_X)
+    n = H[-1, -1]
+    # the translation c adds c to the coefficients of the ones column
+    ones = np.zeros((H.shape[0], 1), dtype=C_X.dtype)
+    ones[-1] = 1
+    C_Z = np.zeros((H.shape[0], p_X - p_Y), dtype=C_X.dtype)
+    for i in range(n_iter_max):
+        R, rho, c = procrustes_gram(H, np.hstack((C_Y, C_Z)), C_X)
+        C_X_new = C_X @ R * rho + ones * c
+        C_Z_new = C_X_new[:, p_Y:]
+        Z_new_mean = H[-1] @ C_Z_new / n
+        C_Z_diff = C_Z_new - C_Z
+        epsilon = np.sum(C_Z_diff * (H @ C_Z_diff)) / (np.sum(C_Z_new * (H @ C_Z_new)) - n * Z_new_mean @ Z_new_mean)
+        if(epsilon < epsilon_min):
+            break
+        else:
+            C_Z = C_Z_new
+    return R, rho, c
+
+
+def _filt_iid_idx(fam, filt_iid):
+    """Positions in the .fam of the samples whose (FID, IID) are in filt_iid"""
+    fam_ids = list(zip(fam['fid'], fam['iid'])) # create tuples of ids from genotyping files
+    fam_mask = [x in filt_iid for x in fam_ids] # T/F overlap of genotype data and filter IDs (tuples)
+    n_matched = sum(fam_mask)
+    if n_matched == 0:
+        raise ValueError(f"ERROR: 0 / {len(filt_iid)} ids in filter list match the study dataset")
+    elif len(set(fam_ids)) != len(fam):
+        raise ValueError("Samples with duplicated FID + IID detected, please remove and retry")
+
+    if n_matched < len(filt_iid):
+        logging.warning('Warning: only {} / {} ids in filter list match the study dataset'.format(n_matched,
+                                                                                                  len(filt_iid)))
+    else:
+        logging.info('Extracted {} samples from study genotyping data'.format(n_matched))
+    return np.array([i for i,x in enumerate(fam_mask) if x is True]) # idx to extract from genotype matrix
+
+
+def read_bed(bed_filepref, dtype=np.int8):
     pyp = PyPlink(bed_filepref)
     bim = pyp.get_bim()
     fam = pyp.get_fam()
     p = len(bim)
     n = len(fam)
 
-    if filt_iid:
-        fam_ids = list(zip(fam['fid'], fam['iid'])) # create tuples of ids from genotyping files
-        fam_mask = [x in filt_iid for x in fam_ids] # T/F overlap of genotype data and filter IDs (tuples)
-        n_matched = sum(fam_mask)
-        if n_matched == 0:
-            raise ValueError(f"ERROR: 0 / {len(filt_iid)} ids in filter list match the study dataset")
-        elif len(set(fam_ids)) != len(fam):
-            raise ValueError("Samples with duplicated FID + IID detected, please remove and retry")
-
-        bed = np.zeros(shape=(p, n_matched), dtype=dtype)
-        i_extract = [i for i,x in enumerate(fam_mask) if x is True] # idx to extract from genotype matrix
-        for (i, (snp, genotypes)) in enumerate(pyp):
-            bed[i,:] = genotypes[i_extract]
-        fam = fam.loc[fam_mask,:]
-        if n_matched < len(filt_iid):
-            logging.warning('Warning: only {} / {} ids in filter list match the study dataset'.format(n_matched,
-                                                                                                      len(filt_iid)))
-        else:
-            logging.info('Extracted {} samples from study genotyping data'.format(n_matched))
-    else:
-        bed = np.zeros(shape=(p, n), dtype=dtype)
-        for (i, (snp, genotypes)) in enumerate(pyp):
-            bed[i,:] = genotypes
+    bed = np.zeros(shape=(p, n), dtype=dtype)
+    for (i, (snp, genotypes)) in enumerate(pyp):
+        bed[i,:] = genotypes
     pyp.close()
     # for i in range(p):
     #     for j in range(n):
@@ -170,6 +251,39 @@ def read_bed(bed_filepref, dtype=np.int8, filt_iid=None):
     return bed, bim, fam
 
 
+def _iter_study_chunks(bed: PackedGenotypes, stu_idx, chunk_size, variants, store: ProjectionStore = None,
+                       var_idx=None):
+    """
+    Yields (first sample, genotype hashes, stored rows, packed genotypes) for consecutive chunks of the study
+    samples, at the variants var_idx if given. With a store, samples whose PC scores are already stored are hashed
+    and left out of the genotypes: their stored rows are >= 0. Without one, hashes and rows are None.
+    """
+    for start in range(0, len(stu_idx), chunk_size):
+        W = bed.take_samples(stu_idx[start:start + chunk_size])
+        if var_idx is not None:
+            W = W.take_variants(var_idx)
+        if variants.match_type == MatchType.DIFFERENT_ORDER:
+            W = _reorder_to_ref(W, variants)
+        hashes = rows = None
+        if store is not None:
+            hashes = hash_samples(W)
+            rows = store.lookup(hashes)
+            W = W.take_samples(np.flatnonzero(rows < 0))
+        yield start, hashes, rows, W
+
+
+def _study_samples(stu_filepref, filt_iid=None, sample_idx=None):
+    """Returns the .bim, and the .fam rows and positions of the study samples to project"""
+    with PyPlink(stu_filepref) as pyp:
+        bim = pyp.get_bim()
+        fam = pyp.get_fam()
+    if filt_iid:
+        sample_idx = _filt_iid_idx(fam, filt_iid)
+    elif sample_idx is None:
+        sample_idx = np.arange(len(fam))
+    return bim, fam.iloc[sample_idx, :], np.asarray(sample_idx)
+
+
 def bim_varlist(bim):
     compcols = ['chrom', 'pos', 'a1', 'a2']
     return [':'.join(map(str, row) )for i, row in bim[compcols].iterrows()]
@@ -218,6 +332,24 @@ def compare_variants(ref_variants: Union[pd.DataFrame, list[str]],
                     study_indexes=stu_indexed)
 
 
+def _thinned_positions(varlist, ref_vars):
+    """Positions of the variants of varlist that are in a thinned reference, or None if the reference has them all"""
+    if len(ref_vars) >= len(varlist):
+        return None
+    ref_vars = set(ref_vars)
+    return np.array([i for i, x in enumerate(varlist) if x in ref_vars], dtype=np.int64)
+
+
+def _reorder_to_ref(G, variants: Variants):
+    """Reorders the rows (variants) of a study genotype matrix to follow the reference variant order"""
+    # study_indexes[i] is the reference position of study variant i, so its inverse permutation
+    # gives the study row that belongs at each reference position
+    order = np.argsort(variants.study_indexes)
+    if isinstance(G, PackedGenotypes):
+        return G.take_variants(order)
+    return G[order, :]
+
+
 def check_varlist(ref_vl: list[str], stu_vl: list[str]) -> MatchType:
     if len(ref_vl) != len(stu_vl):
         return MatchType.DIFFERENT_SIZE
@@ -231,28 +363,31 @@ def check_varlist(ref_vl: list[str], stu_vl: list[str]) -> MatchType:
     return MatchType.ORDERED
 
 
-def save_vars_bim(bim, loc_output):
-    with open(loc_output, 'w') as outf:
-        outf.write('\n'.join(bim_varlist(bim)))
-
-
-def standardize(X, mean=None, std=None, miss=3):
+def standardize(X, mean=None, std=None, miss=3, block_size=None):
     assert np.issubdtype(X.dtype, np.floating)
     p, n = X.shape
-    is_miss = X == miss
-    if (mean is None) or (std is None):
+    if block_size is None:
+        block_size = p
+    compute_mnsd = (mean is None) or (std is None)
+    if compute_mnsd:
         mean = np.zeros(p)
         std = np.zeros(p)
-        for i in range(p):
-            row_nomiss = X[i,:][~is_miss[i,:]]
-            mean[i] = np.mean(row_nomiss)
-            std[i] = np.std(row_nomiss)
-        std[std == 0] = 1
     mean = mean.reshape((-1, 1))
     std = std.reshape((-1, 1))
-    X -= mean
-    X /= std
-    X[is_miss] = 0
+    # Blocks of variants bound the size of the missingness mask
+    for start in range(0, p, max(block_size, 1)):
+        X_block = X[start:start + block_size]
+        is_miss = X_block == miss
+        if compute_mnsd:
+            for i in range(X_block.shape[0]):
+                row_nomiss = X_block[i,:][~is_miss[i,:]]
+                mean[start + i] = np.mean(row_nomiss)
+                std[start + i] = np.std(row_nomiss)
+            std_block = std[start:start + block_size]
+            std_block[std_block == 0] = 1
+        X_block -= mean[start:start + block_size]
+        X_block /= std[start:start + block_size]
+        X_block[is_miss] = 0
     return mean, std
 
 
@@ -264,6 +399,63 @@ def eig_ref(X):
     return s, V, XTX
 
 
+def _packed_xtx(X: PackedGenotypes, X_mean, X_std, block_size, variants=None):
+    """Covariance matrix of the standardized genotypes, accumulated over blocks of variants"""
+    n = X.shape[1]
+    XTX = np.zeros((n, n))
+    for start, X_block in X.iter_blocks(block_size, dtype=np.float32, variants=variants):
+        rows = slice(start, start + X_block.shape[0])
+        standardize(X_block, X_mean[rows], X_std[rows])
+        XTX += X_block.T @ X_block
+    return XTX
+
+
+def eig_ref_packed(X: PackedGenotypes, dim, block_size=BLOCK_SIZE, variants=None):
+    """
+    Reference PCA on packed genotypes (or on the variants at positions variants), unpacking block_size variants at a
+    time: the covariance matrix is accumulated over blocks, then the top dim loadings are computed in a second pass.
+    Apart from the packed genotypes (which can be memory-mapped), only n x n and block_size x n arrays are held in
+    memory.
+    """
+    X_mean, X_std = X.mean_std()
+    if variants is not None:
+        X_mean, X_std = X_mean[variants], X_std[variants]
+    logging.info('Calculating reference covariance matrix in blocks of {} variants...'.format(block_size))
+    XTX = _packed_xtx(X, X_mean, X_std, block_size, variants)
+    logging.info('Eigendecomposition on reference covariance matrix...')
+    s, V = svd_eigcov(XTX)
+    del XTX
+    V = V[:, :dim]
+    U = np.zeros((len(X_mean), dim))
+    logging.info('Calculating reference PC loadings in blocks of {} variants...'.format(block_size))
+    for start, X_block in X.iter_blocks(block_size, dtype=np.float32, variants=variants):
+        rows = slice(start, start + X_block.shape[0])
+        standardize(X_block, X_mean[rows], X_std[rows])
+        U[rows] = X_block @ (V / s[:dim])
+    return X_mean, X_std, s, V, U
+
+
+def _pc_concordance(pcs, pcs_full, dim_ref) -> pd.DataFrame:
+    """Absolute correlation between each of the first dim_ref PCs of two PCAs of the same samples"""
+    report = pd.DataFrame({'PC': ['PC{}'.format(x + 1) for x in range(dim_ref)]})
+    # PCs are only defined up to sign, so compare absolute correlations
+    report['abs_corr'] = [abs(np.corrcoef(pcs[:, j], pcs_full[:, j])[0, 1]) for j in range(dim_ref)]
+    return report
+
+
+def _report_thinning(X: PackedGenotypes, s, V, dim_ref, block_size, out_filepref):
+    """Compares the reference PCs of a thinned reference against those of all the variants"""
+    logging.info('Calculating REFERENCE PCA on all variants to compare with the thinned variants...')
+    X_mean, X_std = X.mean_std()
+    s_full, V_full = svd_eigcov(_packed_xtx(X, X_mean, X_std, block_size))
+    report = _pc_concordance(V[:, :dim_ref] * s[:dim_ref], V_full[:, :dim_ref] * s_full[:dim_ref], dim_ref)
+    report.to_csv(out_filepref + '_thin.tsv', sep='\t', index=False, float_format='%.6f')
+    for row in report.itertuples():
+        logging.info('{}: |correlation| of thinned with all variants {:.6f}'.format(row.PC, row.abs_corr))
+    logging.info('Thinning report saved to {}_thin.tsv'.format(out_filepref))
+    return report
+
+
 def ref_aug_procrustes(pcs_ref, pcs_aug):
     n_ref, p_ref = pcs_ref.shape
     n_aug, p_aug = pcs_aug.shape
@@ -276,16 +468,31 @@ def ref_aug_procrustes(pcs_ref, pcs_aug):
     return pcs_aug_tail_trsfed.flatten()
 
 
-def oadp(U, s, V, b, dim_ref=4, dim_stu=None, dim_online=None):
+def oadp_gram(V, dim_online):
+    ''' Gram matrix of the basis [V, 1] of the reference PC scores, for oadp '''
+    F = np.hstack((V[:, :dim_online], np.ones((V.shape[0], 1), dtype=V.dtype)))
+    return F.T @ F
+
+
+def oadp(U, s, V, b, dim_ref=4, dim_stu=None, dim_online=None, VTV=None):
+    ''' The reference and augmented PC scores are kept as coefficients of the basis [V, 1], so that neither the
+    online SVD nor the Procrustes analysis touch the reference samples. Pass VTV = oadp_gram(V, dim_online) to
+    reuse it across study samples '''
     if dim_stu is None:
         dim_stu = dim_ref * 2
     if dim_online is None:
         dim_online = dim_stu * 2
-    pcs_ref = V[:, :dim_ref] * s[:dim_ref]
-    s_aug, V_aug = svd_online(U[:,:dim_online], s[:dim_online], V[:,:dim_online], b)
-    s_aug, V_aug = s_aug[:dim_stu], V_aug[:, :dim_stu]
-    pcs_aug = V_aug * s_aug
-    pcs_stu = ref_aug_procrustes(pcs_ref, pcs_aug)
+    if VTV is None:
+        VTV = oadp_gram(V, dim_online)
+    s_aug, R_Vt = _svd_online_core(U[:,:dim_online], s[:dim_online], b)
+    # pcs_ref = V @ C_ref, and the reference rows of pcs_aug = V @ C_aug
+    C_ref = np.zeros((dim_online + 1, dim_ref), dtype=s.dtype)
+    C_ref[np.arange(dim_ref), np.arange(dim_ref)] = s[:dim_ref]
+    C_aug = np.zeros((dim_online + 1, dim_stu), dtype=s.dtype)
+    C_aug[:dim_online] = R_Vt[:dim_stu, :dim_online].T * s_aug[:dim_stu]
+    pcs_aug_tail = R_Vt[:dim_stu, dim_online] * s_aug[:dim_stu]
+    R, rho, c = procrustes_diffdim_gram(VTV, C_ref, C_aug)
+    pcs_stu = pcs_aug_tail @ R * rho + c
     return pcs_stu[:dim_ref]
 
 
@@ -307,12 +514,16 @@ def adp(XTX, X, w, pcs_ref, dim_stu=None):
 
 def pca_stu(W, X_mean, X_std, method,
             U=None, s=None, V=None, XTX=None, X=None, pcs_ref=None,
-            dim_ref=None, dim_stu=None, dim_online=None):
+            dim_ref=None, dim_stu=None, dim_online=None, dtype=np.float64):
+    """
+    W is a genotype array or PackedGenotypes, standardized STUDY_BLOCK_SIZE samples at a time. The study genotypes
+    are projected in dtype, which should be that of U, s and V
+    """
     p_ref = len(X_mean)
     p_stu, n_stu = W.shape
     pcs_stu = np.zeros((n_stu, dim_ref))
 
-    if method == 'oadp':
+    if method in ['oadp', 'randoadp']:
         assert all([a is not None for a in [U, s, V, dim_ref, dim_stu, dim_online]])
     if method == 'ap':
         assert all([a is not None for a in [U, dim_ref]])
@@ -321,59 +532,169 @@ def pca_stu(W, X_mean, X_std, method,
     if method == 'adp':
         assert all([a is not None for a in [XTX, X, pcs_ref, dim_ref, dim_stu]])
 
-    reporting_chunk = (n_stu // 10)
-    if reporting_chunk == 0:
-        reporting_chunk = 1
+    if method in ['oadp', 'randoadp']:
+        VTV = oadp_gram(V, dim_online)
+    X_mean = X_mean.astype(dtype)
+    X_std = X_std.astype(dtype)
 
     for i in range(n_stu):
-        w = W[:,i].astype(np.float64).reshape((-1,1))
-        standardize(w, X_mean, X_std, miss=3)
-        if method == 'oadp':
-            pcs_stu[i,:] = oadp(U, s, V, w, dim_ref, dim_stu, dim_online)
+        if i % STUDY_BLOCK_SIZE == 0:
+            block = slice(i, i + STUDY_BLOCK_SIZE)
+            if isinstance(W, PackedGenotypes):
+                W_block = W.unpack(samples=block, dtype=dtype)
+            else:
+                W_block = W[:, block].astype(dtype)
+            standardize(W_block, X_mean, X_std, miss=3)
+        w = W_block[:, i % STUDY_BLOCK_SIZE].reshape((-1,1))
+        if method in ['oadp', 'randoadp']:
+            pcs_stu[i,:] = oadp(U, s, V, w, dim_ref, dim_stu, dim_online, VTV=VTV)
         if method =='sp' or method == 'ap':
             pcs_stu[i,:] = w.T @ U[:,:dim_ref]
         if method =='adp':
             pcs_stu[i,:] = adp(XTX, X, w, pcs_ref, dim_stu=dim_stu)
-        if (i+1) % reporting_chunk == 0:
-            logging.info('Finished {} out of {} study samples.'.format(i+1, n_stu))
 
     del W
     return pcs_stu
 
 
-def _write_pcs(df_pcs, df_fam, colnames, filepref, output_fmt, stage='REFERENCE'):
-    pcs_ref = pd.DataFrame(data=df_pcs, index=df_fam[["fid", "iid"]], columns=colnames)
-    pcs_ref.index = pd.MultiIndex.from_tuples(pcs_ref.index, names=['FID', 'IID'])
-    pcs_ref = pcs_ref.reset_index()  # index to normal columns
-
-    # FID is always a string
-    if all(pcs_ref["FID"] == "0"):
-        # column is present but missing data
-        pcs_ref["FID"] = pcs_ref["IID"]
-
-    pcs_ref.to_csv(filepref + '.pcs', sep='\t', header=True, index=False, float_format=output_fmt)
-    logging.info('{} PC scores saved to {}.pcs'.format(stage, filepref))
+def _write_pcs(df_pcs, df_fam, colnames, filepref, output_fmt, stage='REFERENCE', formats=OUTPUT_FORMATS['both']):
+    """Writes all the PC scores at once. The reference PC scores are saved in both formats, see PcsWriter"""
+    with PcsWriter(filepref, df_fam, colnames, formats=formats, output_fmt=output_fmt) as writer:
+        writer.write(0, df_pcs)
+    logging.info('{} PC scores saved to {}'.format(stage, ', '.join(writer.paths)))
 
 
 def _load_pcs_ref(ref_filepref):
-    """Returns numpy array from pcs file that has row/column names"""
-    return pd.read_csv(ref_filepref + '.pcs', sep='\t', index_col=0).to_numpy()
+    """Returns the saved reference PC scores as a numpy array"""
+    return load_pcs(ref_filepref)[1]
 
 
 def _load_mnsd(ref_filepref):
     """Loads normalization factors (mean/std) from saved _mnsd.dat file"""
-    Xmnsd = np.loadtxt(ref_filepref + '_mnsd.dat')
+    Xmnsd = load_array(ref_filepref + '_mnsd.dat')
     X_mean = Xmnsd[:, 0].reshape((-1, 1))
     X_std = Xmnsd[:, 1].reshape((-1, 1))
     return X_mean, X_std
 
 
+def _load_ref(ref_filepref, method, dim_ref, dim_online):
+    """Loads a saved reference PCA result, memory-mapping the large arrays"""
+    logging.info('Attemping to load saved reference PCA result...')
+    ref = {}
+    ref['X_mean'], ref['X_std'] = _load_mnsd(ref_filepref)
+    if method in ['oadp', 'randoadp']:
+        ref['s'] = load_array(ref_filepref + '_s.dat')
+        ref['U'] = load_array(ref_filepref + '_U.dat')[:, :dim_online]
+        ref['V'] = load_array(ref_filepref + '_V.dat')[:, :dim_online]
+    if method == 'sp':
+        ref['U'] = load_array(ref_filepref + '_U.dat')[:, :dim_ref]
+    if method == 'adp':
+        ref['XTX'] = load_array(ref_filepref + '_XTX.dat')
+    with open(ref_filepref + '_vars.dat', 'r') as infile:
+        ref['vars'] = infile.read().strip().split('\n')
+    if method == 'adp':
+        X, X_bim = read_bed(ref_filepref, dtype=np.float32)[:2]
+        keep = _thinned_positions(bim_varlist(X_bim), ref['vars'])
+        ref['X'] = X if keep is None else X[keep]
+        standardize(ref['X'], ref['X_mean'], ref['X_std'])
+    ref['pcs_ref'] = _load_pcs_ref(ref_filepref)[:, :dim_ref]
+    logging.info('Reference PCA result successfully loaded.')
+    return ref
+
+
+def _fit_ref(ref_filepref, method, dim_ref, dim_online, dim_rand, output_fmt, colnames_pcs,
+             memory_plan: MemoryPlan = None, thin: dict = None):
+    """Runs PCA on the reference samples (on the variants kept by thin_variants, if thin is given) and saves it"""
+    logging.info('Calculating REFERENCE PCA....')
+    in_core = memory_plan is None or memory_plan.ref_in_core
+    block_size = None if memory_plan is None else memory_plan.ref_block_size
+    with PyPlink(ref_filepref) as pyp:
+        X_bim = pyp.get_bim()
+        X_fam = pyp.get_fam()
+    # adp keeps the standardized genotypes and randoadp needs them all at once, oadp and sp work on blocks of the
+    # packed genotypes, read into memory unless they don't fit
+    dense = method in ['adp', 'randoadp']
+    packed = open_bed(ref_filepref, len(X_bim), len(X_fam))
+    if in_core and not dense:
+        packed = packed.load()
+    keep = None
+    if thin is not None:
+        keep = np.flatnonzero(thin_variants(packed, X_bim, **thin))
+        X_bim = X_bim.iloc[keep]
+    if dense:
+        X = read_bed(ref_filepref, dtype=np.float32)[0]
+        if keep is not None:
+            X = X[keep]
+        X_mean, X_std = standardize(X, block_size=block_size)
+        if method == 'randoadp':
+            s, Vt = randomized_svd(X, dim_rand)[1:]
+            V = Vt.T
+        else:
+            s, V, XTX = eig_ref(X)
+    else:
+        X_mean, X_std, s, V, U = eig_ref_packed(packed, dim_online if method == 'oadp' else dim_ref,
+                                                block_size or BLOCK_SIZE, variants=keep)
+    if thin is not None:
+        _report_thinning(packed, s, V, dim_ref, block_size or BLOCK_SIZE, ref_filepref)
+    del packed
+    ref = {'X_mean': X_mean, 'X_std': X_std, 'vars': bim_varlist(X_bim)}
+    if method in ['oadp', 'randoadp']:
+        V = V[:, :dim_online]
+        if dense:
+            U = X @ (V / s[:dim_online])
+        save_array(ref_filepref + '_s.dat', s)
+        save_array(ref_filepref + '_V.dat', V)
+        save_array(ref_filepref + '_U.dat', U)
+        ref.update({'U': U, 's': s, 'V': V})
+    if method == 'sp':
+        V = V[:, :dim_ref]
+        save_array(ref_filepref + '_U.dat', U)
+        ref['U'] = U
+    if method == 'adp':
+        save_array(ref_filepref + '_XTX.dat', XTX)
+        ref.update({'XTX': XTX, 'X': X})
+    ref['pcs_ref'] = V[:, :dim_ref] * s[:dim_ref]
+    save_array(ref_filepref + '_mnsd.dat', np.hstack((X_mean, X_std)))
+    _write_pcs(ref['pcs_ref'], X_fam, colnames_pcs, ref_filepref, output_fmt)
+    with atomic_write(ref_filepref + '_vars.dat') as outf:
+        outf.write('\n'.join(ref['vars']))
+    return ref
+
+
+def _reference_pca(cache: ReferenceCache, method, dim_ref, dim_online, dim_rand, output_fmt, colnames_pcs,
+                   memory_plan: MemoryPlan = None, thin: dict = None):
+    """Loads the saved reference PCA result if it is valid for these parameters, otherwise fits and saves it"""
+    with cache.lock(exclusive=False):
+        if cache.is_valid():
+            return _load_ref(cache.ref_filepref, method, dim_ref, dim_online)
+    with cache.lock(exclusive=True):
+        # Another job may have computed the result while this one was waiting for the lock
+        if cache.is_valid(quiet=True):
+            return _load_ref(cache.ref_filepref, method, dim_ref, dim_online)
+        key = cache.read_key()
+        if key is not None and key['updates']:
+            # refitting from the .bed would drop the samples added since
+            raise ValueError("The saved REFERENCE PCA result for {} includes samples added by fraposa_update_ref and "
+                             "cannot be refitted from {}.bed. Please use the parameters it was saved with ({}), or "
+                             "delete {} to refit without the added samples".format(
+                                 cache.ref_filepref, cache.ref_filepref, cache.key_path, cache.key_path))
+        cache.invalidate()
+        ref = _fit_ref(cache.ref_filepref, method, dim_ref, dim_online, dim_rand, output_fmt, colnames_pcs,
+                       memory_plan, thin)
+        cache.commit()
+        return ref
+
+
 def pca(ref_filepref, stu_filepref=None, stu_filt_iid=None, out_filepref=None, method='oadp',
-        dim_ref=4, dim_stu=None, dim_online=None, dim_rand=None, dim_spikes=None, dim_spikes_max=None):
+        dim_ref=4, dim_stu=None, dim_online=None, dim_rand=None, dim_spikes=None, dim_spikes_max=None,
+        stu_sample_idx=None, max_memory=None, projection_store=None, precision='float64', min_maf=None, ld_r2=None,
+        ld_window=50, output_format='tsv'):
 
     create_logger(out_filepref)
     assert method in ['randoadp', 'oadp', 'ap', 'adp', 'sp']
-    if method in ['oadp', 'adp']:
+    assert precision in ['float64', 'float32']
+    assert output_format in OUTPUT_FORMATS
+    if method in ['oadp', 'randoadp', 'adp']:
         if dim_stu is None:
             dim_stu = dim_ref * 2
         assert dim_ref <= dim_stu
@@ -394,6 +715,8 @@ def pca(ref_filepref, stu_filepref=None, stu_filt_iid=None, out_filepref=None, m
     logging.info('Output prefix: {}'.format(out_filepref))
     logging.info('Method: {}'.format(method))
     logging.info('Reference dimension: {}'.format(dim_ref))
+    if precision != 'float64':
+        logging.info('Precision: {}'.format(precision))
     colnames_pcs = ['PC{}'.format(x + 1) for x in range(dim_ref)]
     if method in ['oadp', 'adp']:
         logging.info('Study dimension: {}'.format(dim_stu))
@@ -410,36 +733,34 @@ def pca(ref_filepref, stu_filepref=None, stu_filt_iid=None, out_filepref=None, m
         sys.exit(1)
 
     logging.info(datetime.now())
+    if stu_filepref is not None:
+        W_bim, W_fam, stu_idx = _study_samples(stu_filepref, filt_iid=stu_filt_iid, sample_idx=stu_sample_idx)
+    memory_plan = None
+    if max_memory is not None:
+        memory_plan = plan_memory(max_memory, method,
+                                  n_variants=_count_lines(ref_filepref + '.bim', ref_filepref + '_vars.dat'),
+                                  n_ref=_count_lines(ref_filepref + '.fam', ref_filepref + '.pcs', fallback_header=True),
+                                  n_stu=len(stu_idx) if stu_filepref is not None else 0,
+                                  dim_ref=dim_ref, dim_online=dim_online)
+        memory_plan.log()
+
+    params = {'method': method, 'dim_ref': dim_ref, 'dim_stu': dim_stu, 'dim_online': dim_online, 'dim_rand': dim_rand}
+    thin = None
+    if min_maf is not None or ld_r2 is not None:
+        thin = {'min_maf': min_maf, 'ld_r2': ld_r2, 'ld_window': ld_window if ld_r2 is not None else None}
+        # only present when thinning, so that saved unthinned results stay valid
+        params['thin'] = thin
+    cache = ReferenceCache(ref_filepref, params=params)
+    ref = _reference_pca(cache, method, dim_ref, dim_online, dim_rand, output_fmt, colnames_pcs, memory_plan, thin)
+    X_mean, X_std = ref['X_mean'], ref['X_std']
     if method in ['oadp', 'randoadp']:
-        try:
-            logging.info('Attemping to load saved reference PCA result...')
-            X_mean, X_std = _load_mnsd(ref_filepref)
-            s = np.loadtxt(ref_filepref+'_s.dat')
-            U = np.loadtxt(ref_filepref+'_U.dat')[:, :dim_online]
-            V = np.loadtxt(ref_filepref+'_V.dat')[:, :dim_online]
-            pcs_ref = _load_pcs_ref(ref_filepref)[:, :dim_ref]
-            logging.info('Warning: If you have changed the parameter settings, please delete '
-                         + ref_filepref + '_*.dat and ' + ref_filepref + '.pcs then rerun FRAPOSA.')
-            logging.info('Reference PCA result successfully loaded.')
-        except OSError:
-            logging.info('REFERENCE PCA result is either nonexistent or incomplete.')
-            logging.info('Calculating REFERENCE PCA....')
-            X, X_bim, X_fam = read_bed(ref_filepref, dtype=np.float32)
-            X_mean, X_std = standardize(X)
-            if method == 'oadp':
-                s, V = eig_ref(X)[:2]
-            elif method == 'randoadp':
-                s, V = randomized_svd(X, dim_rand)[:2]
-            V = V[:, :dim_online]
-            pcs_ref = V[:, :dim_ref] * s[:dim_ref]
-            U = X @ (V / s[:dim_online])
-            np.savetxt(ref_filepref+'_mnsd.dat', np.hstack((X_mean, X_std)), fmt=output_fmt)
-            np.savetxt(ref_filepref+'_s.dat', s, fmt=output_fmt)
-            np.savetxt(ref_filepref+'_V.dat', V, fmt=output_fmt)
-            np.savetxt(ref_filepref+'_U.dat', U, fmt=output_fmt)
-            _write_pcs(pcs_ref, X_fam, colnames_pcs, ref_filepref, output_fmt)
-            save_vars_bim(X_bim, ref_filepref+'_vars.dat')
-        pca_stu_kwargs = {'U':U, 's':s, 'V':V, 'pcs_ref':pcs_ref, 'dim_ref':dim_ref, 'dim_stu':dim_stu, 'dim_online':dim_online}
+        pca_stu_kwargs = {'U':ref['U'], 's':ref['s'], 'V':ref['V'], 'pcs_ref':ref['pcs_ref'], 'dim_ref':dim_ref,
+                          'dim_stu':dim_stu, 'dim_online':dim_online}
+    if method == 'sp':
+        pca_stu_kwargs = {'U':ref['U'], 'dim_ref':dim_ref}
+    if method == 'adp':
+        pca_stu_kwargs = {'pcs_ref':ref['pcs_ref'], 'XTX':ref['XTX'], 'X':ref['X'], 'dim_ref':dim_ref,
+                          'dim_stu':dim_stu}
 
     # Commented to remove requirement for R
     # if method == 'ap':
@@ -475,99 +796,381 @@ def pca(ref_filepref, stu_filepref=None, stu_filt_iid=None, out_filepref=None, m
     #         save_vars_bim(X_bim, ref_filepref + '_vars.dat')
     #     pca_stu_kwargs = {'U':Ushrink, 'dim_ref':dim_ref}
 
-    if method == 'sp':
-        saved_filesuffs = ['_mnsd.dat', '_U.dat']
-        saved_allexist = all([os.path.isfile(ref_filepref+suff) for suff in saved_filesuffs])
-        try:
-            logging.info('Attemping to load saved reference PCA result...')
-            X_mean, X_std = _load_mnsd(ref_filepref)
-            U = np.loadtxt(ref_filepref+'_U.dat')[:, :dim_ref]
-            logging.info('Warning: If you have changed the parameter settings, please delete '
-                         + ref_filepref + '_*.dat and ' + ref_filepref + '.pcs then rerun FRAPOSA.')
-            logging.info('Reference PCA result loaded.')
-        except OSError:
-            logging.info('REFERENCE PCA result is either nonexistent or incomplete.')
-            logging.info('Calculating REFERENCE PCA....')
-            X, X_bim, X_fam = read_bed(ref_filepref, dtype=np.float32)
-            X_mean, X_std = standardize(X)
-            s, V = eig_ref(X)[:2]
-            V = V[:, :dim_ref]
-            pcs_ref = V[:, :dim_ref] * s[:dim_ref]
-            U = X @ (V / s[:dim_ref])
-            np.savetxt(ref_filepref+'_mnsd.dat', np.hstack((X_mean, X_std)), fmt=output_fmt)
-            _write_pcs(pcs_ref, X_fam, colnames_pcs, ref_filepref, output_fmt)
-            np.savetxt(ref_filepref+'_U.dat', U, fmt=output_fmt)
-            save_vars_bim(X_bim, ref_filepref + '_vars.dat')
-        pca_stu_kwargs = {'U':U, 'dim_ref':dim_ref}
-
-    if method == 'adp':
-        saved_filesuffs = ['_mnsd.dat', '_XTX.dat', '_Vs.dat']
-        saved_allexist = all([os.path.isfile(ref_filepref+suff) for suff in saved_filesuffs])
-        X, X_bim, X_fam = read_bed(ref_filepref, dtype=np.float32)
-        try:
-            logging.info('Attemping to load saved reference PCA result...')
-            X_mean, X_std = _load_mnsd(ref_filepref)
-            XTX = np.loadtxt(ref_filepref+'_XTX.dat')[:, :dim_ref]
-            standardize(X, X_mean, X_std)
-            pcs_ref = _load_pcs_ref(ref_filepref)[:, :dim_ref]
-            logging.info('Warning: If you have changed the parameter settings, please delete '
-                         + ref_filepref + '_*.dat and ' + ref_filepref + '.pcs then rerun FRAPOSA.')
-            logging.info('Reference PCA result loaded.')
-        except OSError:
-            logging.info('REFERENCE PCA result is either nonexistent or incomplete.')
-            logging.info('Calculating REFERENCE PCA....')
-            X_mean, X_std = standardize(X)
-            s, V, XTX = eig_ref(X)
-            V = V[:, :dim_ref]
-            pcs_ref = V[:, :dim_ref] * s[:dim_ref]
-            np.savetxt(ref_filepref+'_mnsd.dat', np.hstack((X_mean, X_std)), fmt=output_fmt)
-            _write_pcs(pcs_ref, X_fam, colnames_pcs, ref_filepref, output_fmt)
-            save_vars_bim(X_bim, ref_filepref + '_vars.dat')
-        pca_stu_kwargs = {'pcs_ref':pcs_ref, 'XTX':XTX, 'X':X, 'dim_ref':dim_ref, 'dim_stu':dim_stu}
-
     if stu_filepref is not None:
         logging.info(datetime.now())
         logging.info('Loading study data...')
-        W, W_bim, W_fam = read_bed(stu_filepref, dtype=np.int8, filt_iid=stu_filt_iid)
-
+        # The reference PCA is always computed (and saved) in float64, the study is projected in the chosen
+        # precision. Only the arrays of the oadp/sp projection are cast, adp keeps its float32 reference genotypes
+        dtype = np.dtype(precision)
+        pca_stu_kwargs_dtype = dict(pca_stu_kwargs)
+        for x in ['U', 's', 'V']:
+            if x in pca_stu_kwargs and pca_stu_kwargs[x].dtype != dtype:
+                pca_stu_kwargs_dtype[x] = pca_stu_kwargs[x].astype(dtype)
+        stu_vars = bim_varlist(W_bim)
+        stu_keep = None
+        if thin is not None:
+            # only the variants kept in the thinned reference are read from the study
+            stu_keep = _thinned_positions(stu_vars, ref['vars'])
+            if stu_keep is not None:
+                stu_vars = [stu_vars[i] for i in stu_keep]
         # check to see that the variants are compatible between reference and study
-        try:
-            variants: Variants = compare_variants(ref_variants=X_bim, study_variants=W_bim)
-        except NameError:
-            with open(ref_filepref + '_vars.dat', 'r') as infile:
-                ref_vars = infile.read().strip().split('\n')
-            stu_vars = bim_varlist(W_bim)
-            variants: Variants = compare_variants(ref_variants=ref_vars, study_variants=stu_vars)
-
+        variants: Variants = compare_variants(ref_variants=ref['vars'], study_variants=stu_vars)
         if variants.match_type == MatchType.DIFFERENT_ORDER:
             logging.info("Re-indexing variants and genotypes because study variant order was different to reference")
-            W = W[variants.study_indexes, :]
-            W_bim = W_bim.reindex(variants.study_variants)
 
+        n_stu = len(stu_idx)
+        chunk_size = min(n_stu, STUDY_CHUNK_SIZE) if memory_plan is None else memory_plan.study_chunk_size
+        pcs_stu = np.zeros((n_stu, dim_ref))
         logging.info(datetime.now())
         logging.info('Predicting study PC scores (method: ' + method + ')...')
         t0 = time.time()
-        pcs_stu = pca_stu(W, X_mean, X_std, method, **pca_stu_kwargs)
+        store = None
+        model = cache.model_fingerprint()
+        if projection_store is not None and model is None:
+            logging.warning('The saved REFERENCE PCA result has no key, study PC scores will not be stored.')
+        elif projection_store is not None:
+            store = ProjectionStore(projection_store, model=model, params=dict(cache.params, precision=precision))
+            store.load()
+            stu_hashes = np.zeros(n_stu, dtype='S32')
+            n_reused = 0
+        projected = np.zeros(n_stu, dtype=bool)
+        bed = open_bed(stu_filepref, len(W_bim), _count_lines(stu_filepref + '.fam'))
+        # The next chunk is read in the background while the current one is projected, and the PC scores of each
+        # chunk are written as soon as it is finished
+        chunks = _iter_study_chunks(bed, stu_idx, chunk_size, variants, store, stu_keep)
+        writer = PcsWriter(out_filepref, W_fam, colnames_pcs, formats=OUTPUT_FORMATS[output_format],
+                           output_fmt=output_fmt)
+        with writer:
+            for start, hashes, rows, W in prefetch(chunks, depth=1):
+                chunk = np.arange(start, min(start + chunk_size, n_stu))
+                if store is not None:
+                    stu_hashes[chunk] = hashes
+                    pcs_stu[chunk[rows >= 0]] = store.pcs[rows[rows >= 0]]
+                    n_reused += np.sum(rows >= 0)
+                    chunk = chunk[rows < 0]
+                if W.shape[1] > 0:
+                    pcs_stu[chunk] = pca_stu(W, X_mean, X_std, method, dtype=dtype, **pca_stu_kwargs_dtype)
+                    projected[chunk] = True
+                del W
+                n_done = min(start + chunk_size, n_stu)
+                logging.info('Finished {} out of {} study samples ({:.1f} samples/sec).'.format(
+                    n_done, n_stu, n_done / (time.time() - t0)))
+                writer.write(start, pcs_stu[start:n_done])
+        logging.info('STUDY PC scores saved to {}'.format(', '.join(writer.paths)))
         elapse_stu = time.time() - t0
-
-        # Write output
-        _write_pcs(pcs_stu, W_fam, colnames_pcs, out_filepref, output_fmt, stage='STUDY')
+        if store is not None:
+            logging.info('Reused the stored PC scores of {} out of {} study samples.'.format(n_reused, n_stu))
+            store.save(stu_hashes, pcs_stu)
+        if dtype != np.float64 and np.any(projected):
+            _check_precision(bed, stu_idx, np.flatnonzero(projected), pcs_stu, variants, X_mean, X_std, method,
+                             pca_stu_kwargs, ref['pcs_ref'], stu_keep)
 
         # Finish & Log
         logging.info('Study time: {} sec'.format(elapse_stu, 1))
         logging.info(datetime.now())
         logging.info('FRAPOSA finished.')
+        # What the study PC scores were computed with, recorded by run_shard
+        return {'model': model, 'params': dict(cache.params, precision=precision)}
+
+
+def _check_precision(bed, stu_idx, projected, pcs_stu, variants, X_mean, X_std, method, pca_stu_kwargs, pcs_ref,
+                     var_idx=None):
+    """
+    Re-projects a random subsample of the projected study samples in float64 and warns if their PC scores deviate by
+    more than PRECISION_TOLERANCE reference PC standard deviations. Returns the largest deviation
+    """
+    rng = np.random.default_rng(0)
+    check = np.sort(rng.choice(projected, min(PRECISION_CHECK_SAMPLES, len(projected)), replace=False))
+    W = next(_iter_study_chunks(bed, stu_idx[check], len(check), variants, var_idx=var_idx))[3]
+    pcs_check = pca_stu(W, X_mean, X_std, method, **pca_stu_kwargs)
+    deviation = np.max(np.abs(pcs_stu[check] - pcs_check) / np.std(pcs_ref, axis=0))
+    logging.info('Largest deviation from float64 in {} re-projected study samples: {:.2g} reference PC standard '
+                 'deviations.'.format(len(check), deviation))
+    if deviation > PRECISION_TOLERANCE:
+        logging.warning('Study PC scores computed in reduced precision deviate from float64 by more than {} reference '
+                        'PC standard deviations, consider using --precision float64.'.format(PRECISION_TOLERANCE))
+    return deviation
+
+
+def _count_lines(path, fallback_path=None, fallback_header=False):
+    """Number of lines of path, or of fallback_path (excluding its header, if any) if path does not exist"""
+    header = False
+    if not os.path.exists(path) and fallback_path is not None:
+        path, header = fallback_path, fallback_header
+    with open(path, 'r') as infile:
+        return sum(1 for _ in infile) - header
+
+
+def _shard_filepref(plan_filepref, shard):
+    return '{}_shard{}'.format(plan_filepref, shard)
+
+
+def plan_shards(stu_filepref, n_shards, plan_filepref=None):
+    """Splits the study samples into n_shards contiguous blocks of .fam positions and saves the plan"""
+    if plan_filepref is None:
+        plan_filepref = stu_filepref
+    create_logger(plan_filepref + '_shards')
+    with PyPlink(stu_filepref) as pyp:
+        fam = pyp.get_fam()
+    n = len(fam)
+    if not 0 < n_shards <= n:
+        raise ValueError("Number of shards must be between 1 and the number of study samples ({})".format(n))
+    bounds = np.linspace(0, n, n_shards + 1).astype(int)
+    # absolute, so that shards can be run from any working directory
+    plan = {'study': os.path.abspath(stu_filepref),
+            'fam': fingerprint_files([stu_filepref + '.fam']),
+            'n_samples': n,
+            'shards': [[int(start), int(end)] for start, end in zip(bounds[:-1], bounds[1:])]}
+    with atomic_write(plan_filepref + '_shards.json') as f:
+        json.dump(plan, f, indent=2)
+    logging.info('Planned {} shards of {} study samples in {}_shards.json'.format(n_shards, n, plan_filepref))
+    return plan
+
+
+def _load_shard_plan(plan_filepref):
+    with open(plan_filepref + '_shards.json', 'r') as f:
+        plan = json.load(f)
+    if fingerprint_files([plan['study'] + '.fam']) != plan['fam']:
+        raise ValueError("{}.fam has changed since the shards were planned, please rerun fraposa_shard".format(
+            plan['study']))
+    return plan
+
+
+def run_shard(ref_filepref, plan_filepref, shard, out_filepref=None, **pca_kwargs):
+    """Projects the study samples of one planned shard, saving partial PC scores to {plan_filepref}_shard{shard}"""
+    plan = _load_shard_plan(plan_filepref)
+    if not 0 <= shard < len(plan['shards']):
+        raise ValueError("Shard {} not in plan (shards 0 to {})".format(shard, len(plan['shards']) - 1))
+    if out_filepref is None:
+        out_filepref = _shard_filepref(plan_filepref, shard)
+    start, end = plan['shards'][shard]
+    # the reference model and parameters of the shard, checked by merge_shards
+    key_path = out_filepref + '_shard.json'
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    key = pca(ref_filepref, stu_filepref=plan['study'], out_filepref=out_filepref,
+              stu_sample_idx=np.arange(start, end), **pca_kwargs)
+    with atomic_write(key_path) as f:
+        json.dump(key, f, indent=2)
+
+
+def merge_shards(plan_filepref, out_filepref=None, output_format='tsv'):
+    """Checks that every planned shard has been projected and concatenates the PC scores in .fam order"""
+    plan = _load_shard_plan(plan_filepref)
+    if out_filepref is None:
+        out_filepref = plan['study']
+    create_logger(out_filepref + '_merge')
+    with PyPlink(plan['study']) as pyp:
+        fam = pyp.get_fam()
+
+    parts = []
+    keys = {}
+    missing = []
+    for shard, (start, end) in enumerate(plan['shards']):
+        filepref = _shard_filepref(plan_filepref, shard)
+        try:
+            ids, part = load_pcs(filepref)
+            with open(filepref + '_shard.json', 'r') as f:
+                keys[shard] = json.load(f)
+        except OSError:
+            missing.append(shard)
+            continue
+        # shards left over from an earlier run can have been projected with another reference model or parameters
+        first = next(iter(keys))
+        if keys[shard] != keys[first]:
+            raise ValueError("{}.pcs was projected with a different reference model or parameters to shard {}, "
+                             "please rerun it".format(filepref, first))
+        # IIDs can be duplicated with distinct FIDs, so both are compared
+        expected = pcs_ids(fam.iloc[start:end])
+        if not ids.reset_index(drop=True).equals(expected):
+            raise ValueError("{}.pcs does not contain samples {} to {} of {}.fam".format(
+                filepref, start + 1, end, plan['study']))
+        if parts and part.shape[1] != parts[0].shape[1]:
+            raise ValueError("{}.pcs has different PCs to the other shards".format(filepref))
+        parts.append(part)
+    if missing:
+        raise ValueError("No PC scores found for shard(s): {}".format(', '.join(map(str, missing))))
+
+    colnames_pcs = ['PC{}'.format(x + 1) for x in range(parts[0].shape[1])]
+    with PcsWriter(out_filepref, fam, colnames_pcs, formats=OUTPUT_FORMATS[output_format]) as writer:
+        for part in parts:
+            writer.write(writer.n_written, part)
+    logging.info('STUDY PC scores of {} shards ({} samples) merged to {}'.format(
+        len(parts), len(fam), ', '.join(writer.paths)))
+
+
+def _load_pcs_ids(ref_filepref):
+    """Returns the FID/IID columns of a pcs file in the same layout as a PyPlink fam"""
+    ids = load_pcs(ref_filepref)[0]
+    ids.columns = ['fid', 'iid']
+    return ids
+
+
+def _pooled_mnsd(mean_1, var_1, n_1, mean_2, var_2, n_2):
+    """Combines per-variant means and variances of two groups of samples into means and standard deviations"""
+    n = n_1 + n_2
+    mean = (n_1 * mean_1 + n_2 * mean_2) / n
+    var = (n_1 * (var_1 + (mean_1 - mean) ** 2) + n_2 * (var_2 + (mean_2 - mean) ** 2)) / n
+    std = np.sqrt(var)
+    std[std == 0] = 1
+    return mean, std
+
+
+def _report_drift(ref_filepref, new_filepref, variants, s, pcs, dim_ref, out_filepref, new_idx=None):
+    """Compares incrementally updated reference PCs against a full refit of the combined reference"""
+    logging.info('Refitting the combined reference from scratch to measure drift...')
+    X, X_bim = read_bed(ref_filepref, dtype=np.float32)[:2]
+    X_keep = _thinned_positions(bim_varlist(X_bim), variants.reference_variants)
+    if X_keep is not None:
+        X = X[X_keep]
+    Y = read_bed(new_filepref, dtype=np.float32)[0]
+    if new_idx is not None:
+        Y = Y[new_idx]
+    if variants.match_type == MatchType.DIFFERENT_ORDER:
+        Y = _reorder_to_ref(Y, variants)
+    X = np.hstack((X, Y))
+    del Y
+    standardize(X)
+    s_full, V_full = eig_ref(X)[:2]
+    pcs_full = V_full[:, :dim_ref] * s_full[:dim_ref]
+
+    drift = _pc_concordance(pcs, pcs_full, dim_ref)
+    drift.insert(1, 's_incremental', s[:dim_ref])
+    drift.insert(2, 's_refit', s_full[:dim_ref])
+    drift.insert(3, 's_reldiff', np.abs(drift['s_incremental'] - drift['s_refit']) / drift['s_refit'])
+    drift.to_csv(out_filepref + '_drift.tsv', sep='\t', index=False, float_format='%.6f')
+    for row in drift.itertuples():
+        logging.info('{}: singular value relative difference {:.2e}, |correlation| with refit {:.6f}'.format(
+            row.PC, row.s_reldiff, row.abs_corr))
+    logging.info('Drift report saved to {}_drift.tsv'.format(out_filepref))
+    return drift
+
+
+def update_ref(ref_filepref, new_filepref, out_filepref=None, dim_ref=None, batch_size=256, check_drift=False):
+    """
+    Folds new reference samples into a saved oadp reference PCA result without refitting from scratch.
+
+    The saved mean/std are pooled with the new samples, the existing rank-k model is re-standardized with a
+    rescaling and a rank-one mean shift, then the new (standardized) samples are appended in batches with rank-m
+    SVD updates. The result is exact with respect to the truncated rank-k model; the residual that was discarded
+    when the model was first truncated is what makes it drift from a full refit.
+    """
+    if out_filepref is None:
+        out_filepref = ref_filepref
+    output_fmt = '%.4f'
+    create_logger(out_filepref + '_update')
+
+    logging.info('FRAPOSA reference update started.')
+    logging.info('Reference data: {}'.format(ref_filepref))
+    logging.info('New reference samples: {}'.format(new_filepref))
+    logging.info('Output prefix: {}'.format(out_filepref))
+    logging.info(datetime.now())
+
+    src = ReferenceCache(ref_filepref)
+    dst = src if out_filepref == ref_filepref else ReferenceCache(out_filepref)
+    # An in-place update holds the exclusive lock throughout so that concurrent updates cannot overwrite each other
+    with dst.lock(exclusive=True), (nullcontext() if dst is src else src.lock(exclusive=False)):
+        logging.info('Loading saved reference PCA result...')
+        key = src.read_key()
+        if key is None or key['params']['method'] not in ['oadp', 'randoadp']:
+            raise ValueError("No saved oadp reference PCA result for {}, please run fraposa on the reference "
+                             "first".format(ref_filepref))
+        if not src.reference_unchanged(key['reference']):
+            raise ValueError("Reference genotypes have changed since the saved reference PCA result for {} was "
+                             "computed, please rerun fraposa on the reference first".format(ref_filepref))
+        # The saved parameters are kept, dim_ref only sets the PCs of the drift report (and extra PCs in .pcs)
+        if dim_ref is None:
+            dim_ref = key['params']['dim_ref']
+        if dim_ref > key['params']['dim_stu']:
+            raise ValueError("dim_ref ({}) cannot be larger than the dim_stu ({}) of the saved reference PCA result "
+                             "for {}".format(dim_ref, key['params']['dim_stu'], ref_filepref))
+        X_mean, X_std = _load_mnsd(ref_filepref)
+        U = load_array(ref_filepref + '_U.dat')
+        V = load_array(ref_filepref + '_V.dat')
+        dim_online = U.shape[1]
+        s = load_array(ref_filepref + '_s.dat')[:dim_online]
+        assert dim_ref <= dim_online
+        ref_ids = _load_pcs_ids(ref_filepref)
+        n_ref = V.shape[0]
+        assert len(ref_ids) == n_ref
+        with open(ref_filepref + '_vars.dat', 'r') as infile:
+            ref_vars = infile.read().strip().split('\n')
+        logging.info('Reference PCA result loaded ({} samples, {} online SVD dimensions).'.format(n_ref, dim_online))
+
+        logging.info('Loading new reference samples...')
+        Y, Y_bim, Y_fam = read_bed(new_filepref, dtype=np.int8)
+        Y_vars = bim_varlist(Y_bim)
+        Y_keep = _thinned_positions(Y_vars, ref_vars) if 'thin' in key['params'] else None
+        if Y_keep is not None:
+            Y, Y_vars = Y[Y_keep], [Y_vars[i] for i in Y_keep]
+        variants: Variants = compare_variants(ref_variants=ref_vars, study_variants=Y_vars)
+        if variants.match_type == MatchType.DIFFERENT_ORDER:
+            Y = _reorder_to_ref(Y, variants)
+        n_new = Y.shape[1]
+
+        # Missing genotypes (coded 3) are excluded from the new samples' summary statistics
+        is_miss = Y == 3
+        n_obs = np.sum(~is_miss, axis=1)
+        Y_obs = np.where(is_miss, 0, Y).astype(np.float64)
+        new_mean = Y_obs.sum(axis=1) / np.maximum(n_obs, 1)
+        new_var = np.sum(np.square(Y_obs - new_mean.reshape((-1, 1))) * ~is_miss, axis=1) / np.maximum(n_obs, 1)
+        del Y_obs, is_miss
+        # standardize saves a std of 1 for variants that are monomorphic in the reference, whose standardized rows
+        # (and so loadings) are exactly 0: their variance is 0
+        X_var = np.where(np.all(U == 0, axis=1), 0, X_std.flatten() ** 2)
+        # _mnsd.dat does not record missingness, so the saved statistics are weighted by the reference sample size
+        mean, std = _pooled_mnsd(X_mean.flatten(), X_var, n_ref, new_mean, new_var, n_obs)
+
+        logging.info('Re-standardizing the saved reference model...')
+        # (G - mean) / std = (X_std / std) * X + (X_mean - mean) / std
+        U, s, V = svd_update(U * (X_std.flatten() / std).reshape((-1, 1)), s, V,
+                             (X_mean.flatten() - mean) / std, np.ones(n_ref), l=dim_online)
+
+        logging.info('Adding {} new samples to the reference model...'.format(n_new))
+        for start in range(0, n_new, batch_size):
+            B = Y[:, start:start + batch_size].astype(np.float64)
+            standardize(B, mean, std, miss=3)
+            n_cur, n_batch = V.shape[0], B.shape[1]
+            V = np.vstack((V, np.zeros((n_batch, dim_online))))
+            E = np.vstack((np.zeros((n_cur, n_batch)), np.eye(n_batch)))
+            U, s, V = svd_update(U, s, V, B, E, l=dim_online)
+            logging.info('Finished {} out of {} new reference samples.'.format(start + n_batch, n_new))
+        del Y
+
+        # .pcs keeps at least the saved number of PCs, so that the saved result still matches its key
+        n_pcs = max(dim_ref, key['params']['dim_ref'])
+        pcs_ref = V[:, :n_pcs] * s[:n_pcs]
+        ids = pd.concat([ref_ids, Y_fam[['fid', 'iid']].astype(str)], ignore_index=True)
+        colnames_pcs = ['PC{}'.format(x + 1) for x in range(n_pcs)]
+        dst.invalidate()
+        save_array(out_filepref + '_mnsd.dat', np.vstack((mean, std)).T)
+        save_array(out_filepref + '_s.dat', s)
+        save_array(out_filepref + '_V.dat', V)
+        save_array(out_filepref + '_U.dat', U)
+        _write_pcs(pcs_ref, ids, colnames_pcs, out_filepref, output_fmt)
+        if out_filepref != ref_filepref:
+            with atomic_write(out_filepref + '_vars.dat') as outf:
+                outf.write('\n'.join(ref_vars))
+        dst.params = key['params']
+        dst.commit(reference=key['reference'], updates=key['updates'] + [fingerprint_plink(new_filepref)])
+
+    if check_drift:
+        if key['updates'] or not os.path.exists(ref_filepref + '.bed'):
+            logging.warning('Skipping drift report: the saved reference PCA result for {} was updated before, '
+                            'so it cannot be refitted from {}.bed alone'.format(ref_filepref, ref_filepref))
+        else:
+            _report_drift(ref_filepref, new_filepref, variants, s, pcs_ref, dim_ref, out_filepref, Y_keep)
+
+    logging.info(datetime.now())
+    logging.info('FRAPOSA reference update finished.')
 
 
 def pred_popu_stu(ref_filepref, stu_filepref, n_neighbors=20, weights='uniform'):
-    # ToDo - test implementation
-    # load reference and study pc scores and population
-    ref_df = pd.read_table(ref_filepref+'.pcs', header=None)
-    stu_df = pd.read_table(stu_filepref+'.pcs', header=None)
+    # load reference and study pc scores (see load_pcs) and population
+    pcs_ref = load_pcs(ref_filepref)[1]
+    stu_ids, pcs_stu = load_pcs(stu_filepref)
     popu_df = pd.read_table(ref_filepref+'.popu', header=None)
-    pcs_ref = ref_df.iloc[:,2:].to_numpy()
-    pcs_stu = stu_df.iloc[:,2:].to_numpy()
-    popu_ref = popu_df.iloc[:,2:].to_numpy()
+    popu_ref = popu_df.iloc[:,2].to_numpy()
     n_stu, p = pcs_stu.shape
 
     popu_list = np.sort(np.unique(popu_ref))
@@ -583,7 +1186,7 @@ def pred_popu_stu(ref_filepref, stu_filepref, n_neighbors=20, weights='uniform')
     popuproba_df = popuproba_df[['popu', 'proba', 'dist']]
     probalist_df = pd.DataFrame(popu_stu_proba_list)
     populist_df = pd.DataFrame(np.tile(popu_list, (n_stu, 1)))
-    popu_stu_pred_df = pd.concat([stu_df.iloc[:,0:2], popuproba_df, probalist_df, populist_df], axis=1)
+    popu_stu_pred_df = pd.concat([stu_ids, popuproba_df, probalist_df, populist_df], axis=1)
     popu_stu_pred_df.to_csv(stu_filepref+'.popu', sep='\t', header=False, index=False)
     print('Predicted study populations saved to ' + stu_filepref + '.popu')
     return popu_stu_pred, popu_stu_proba, popu_stu_dist
@@ -591,8 +1194,8 @@ def pred_popu_stu(ref_filepref, stu_filepref, n_neighbors=20, weights='uniform')
 
 def plot_pcs(ref_filepref, stu_filepref):
     # ToDo - test implementation
-    pcs_ref = np.loadtxt(ref_filepref+'.pcs', dtype=str)[:,2:].astype(float)
-    pcs_stu = np.loadtxt(stu_filepref+'.pcs', dtype=str)[:,2:].astype(float)
+    pcs_ref = load_pcs(ref_filepref)[1]
+    pcs_stu = load_pcs(stu_filepref)[1]
     try:
         popu_ref = np.loadtxt(ref_filepref+'.popu', dtype=str)[:,2].tolist()
     except OSError:
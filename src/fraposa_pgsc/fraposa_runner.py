@@ -2,14 +2,12 @@
 import csv
 
 import fraposa_pgsc.fraposa as fp
+from fraposa_pgsc.memplan import parse_memory
 import argparse
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('ref_filepref', help='Prefix of the binary PLINK file for the reference samples.')
-    parser.add_argument('--stu_filepref', help='Prefix of the binary PLINK file for the study samples.')
-    parser.add_argument('--stu_filt_iid', help='File with list of FIDs and IIDs to extract from the study file (bim format)')
+def add_pca_arguments(parser):
+    """Options shared by every command that runs the reference PCA and study projection"""
     parser.add_argument('--method', help='The method for PCA prediction. oadp: most accurate. adp: accurate but slow. sp: fast but inaccurate. Default is odap.')
     parser.add_argument('--dim_ref', help='Number of PCs you need.')
     parser.add_argument('--dim_stu', help='Number of PCs predicted for the study samples before doing the Procrustes transformation. Only needed for the oadp and adp methods. Default is 2*dim_ref.')
@@ -17,12 +15,17 @@ def main():
     parser.add_argument('--dim_rand', help='Number of reference PCs to calculate when using randomized online SVD')
     parser.add_argument('--dim_spikes', help='Number of PCs to adjust for shrinkage. Only needed for the ap method. If this argument is not set, dim_spikes_max will be used.')
     parser.add_argument('--dim_spikes_max', help='The maximal number of PCs to adjust for shrinkage. Only needed for the ap method. This argument will be ignored if dim_spikes is set. Default is 4*dim_ref.')
-    parser.add_argument('--out', help='Prefix of output file(s). Default is stu_filepref')
-    args=parser.parse_args()
+    parser.add_argument('--max_memory', help='Memory budget (e.g. 16G). The reference PCA and the study projection are split into blocks/chunks that are estimated to fit. Default is no limit.')
+    parser.add_argument('--precision', choices=['float64', 'float32'], help='Floating point precision of the study projection. float32 halves the memory used by the unpacked study genotypes and is about 1.2x faster with oadp; a random subsample of study samples is re-projected in float64 and a warning is logged if their PC scores deviate. Default is float64.')
+    parser.add_argument('--min_maf', help='Thin the reference variants: only use variants with at least this minor allele frequency in the reference. Default is all variants.')
+    parser.add_argument('--ld_r2', help='Thin the reference variants: prune variants in LD (r^2 above this) with a variant kept among the previous --ld_window variants. Default is no pruning.')
+    parser.add_argument('--ld_window', help='Window (number of variants) of the LD pruning. Default is 50.')
+    parser.add_argument('--output_format', choices=['tsv', 'npy', 'both'], help='Format of the study PC scores. tsv: {out}.pcs text file. npy: {out}.pcs.npy binary array with the FIDs and IIDs in {out}.pcs.ids, which is faster to write and read for large studies. both: both formats. Default is tsv.')
+    parser.add_argument('--projection_store', help='Prefix of a store of study PC scores kept across runs. Samples whose genotypes were already projected with the same reference and parameters reuse their stored PC scores, and new samples are added to the store.')
 
-    ref_filepref = args.ref_filepref
-    stu_filepref = None
-    out_filepref = ref_filepref
+
+def pca_kwargs(args):
+    """Converts the options added by add_pca_arguments into keyword arguments for fraposa.pca"""
     method = 'oadp'
     dim_ref = 4
     dim_stu = None
@@ -30,6 +33,60 @@ def main():
     dim_rand = None
     dim_spikes = None
     dim_spikes_max = None
+    max_memory = None
+    projection_store = None
+    precision = 'float64'
+    min_maf = None
+    ld_r2 = None
+    ld_window = 50
+    output_format = 'tsv'
+    if args.method:
+        method = args.method
+    if args.dim_ref:
+        dim_ref = int(args.dim_ref)
+    if args.dim_stu:
+        dim_stu = int(args.dim_stu)
+    if args.dim_online:
+        dim_online = int(args.dim_online)
+    if args.dim_rand:
+        dim_rand = int(args.dim_rand)
+    if args.dim_spikes:
+        dim_spikes = int(args.dim_spikes)
+    if args.dim_spikes_max:
+        dim_spikes_max = int(args.dim_spikes_max)
+    if args.max_memory:
+        max_memory = parse_memory(args.max_memory)
+    if args.precision:
+        precision = args.precision
+    if args.min_maf:
+        min_maf = float(args.min_maf)
+    if args.ld_r2:
+        ld_r2 = float(args.ld_r2)
+    if args.ld_window:
+        ld_window = int(args.ld_window)
+    if args.output_format:
+        output_format = args.output_format
+    if args.projection_store:
+        projection_store = args.projection_store
+
+    return {'method': method, 'dim_ref': dim_ref, 'dim_stu': dim_stu, 'dim_online': dim_online, 'dim_rand': dim_rand,
+            'dim_spikes': dim_spikes, 'dim_spikes_max': dim_spikes_max, 'max_memory': max_memory,
+            'projection_store': projection_store, 'precision': precision, 'min_maf': min_maf, 'ld_r2': ld_r2,
+            'ld_window': ld_window, 'output_format': output_format}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ref_filepref', help='Prefix of the binary PLINK file for the reference samples.')
+    parser.add_argument('--stu_filepref', help='Prefix of the binary PLINK file for the study samples.')
+    parser.add_argument('--stu_filt_iid', help='File with list of FIDs and IIDs to extract from the study file (bim format)')
+    add_pca_arguments(parser)
+    parser.add_argument('--out', help='Prefix of output file(s). Default is stu_filepref')
+    args=parser.parse_args()
+
+    ref_filepref = args.ref_filepref
+    stu_filepref = None
+    out_filepref = ref_filepref
 
     if args.stu_filepref:
         stu_filepref = args.stu_filepref
@@ -52,24 +109,9 @@ def main():
 
     if args.out:
         out_filepref = args.out
-    if args.method:
-        method = args.method
-    if args.dim_ref:
-        dim_ref = int(args.dim_ref)
-    if args.dim_stu:
-        dim_stu = int(args.dim_stu)
-    if args.dim_online:
-        dim_online = int(args.dim_online)
-    if args.dim_rand:
-        dim_rand = int(args.dim_rand)
-    if args.dim_spikes:
-        dim_spikes = int(args.dim_spikes)
-    if args.dim_spikes_max:
-        dim_spikes_max = int(args.dim_spikes_max)
 
     fp.pca(ref_filepref=ref_filepref, stu_filepref=stu_filepref, stu_filt_iid=stu_filt_iid, out_filepref=out_filepref,
-           method=method, dim_ref=dim_ref, dim_stu=dim_stu, dim_online=dim_online, dim_rand=dim_rand,
-           dim_spikes=dim_spikes, dim_spikes_max=dim_spikes_max)
+           **pca_kwargs(args))
 
 
 if __name__ == '__main__':
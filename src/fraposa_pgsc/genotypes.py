@@ -0,0 +1,123 @@
+import numpy as np
+
+# .bed 2-bit genotype codes in the coding of read_bed (number of a2 alleles, 3 = missing)
+_BED_CODES = np.array([0, 3, 1, 2], dtype=np.int8)
+# and the 2 bits that store each genotype
+_BED_BITS = np.argsort(_BED_CODES).astype(np.uint8)
+# genotypes of the 4 samples packed in each possible .bed byte, lowest bits first
+_BYTE_GENOTYPES = _BED_CODES[(np.arange(256).reshape((-1, 1)) >> np.arange(0, 8, 2)) & 3]
+# number of each genotype (0, 1, 2, missing) in each possible .bed byte
+_BYTE_COUNTS = np.stack([np.sum(_BYTE_GENOTYPES == x, axis=1) for x in range(4)], axis=1).astype(np.uint8)
+
+# Variants unpacked at once by the methods that scan all the genotypes
+BLOCK_SIZE = 1024
+
+
+class PackedGenotypes:
+    """
+    Genotypes of n samples at p variants stored as in a SNP-major .bed file: 2 bits per genotype, 4 samples per byte
+    with the first sample in the lowest bits. Unpacked genotypes are coded as in read_bed (number of a2 alleles,
+    3 = missing).
+
+    packed can be a memory-mapped .bed (see open_bed), in which case load() copies it into memory.
+    """
+    def __init__(self, packed, n_samples):
+        assert packed.shape[1] == (n_samples + 3) // 4
+        self.packed = packed
+        self.n_samples = n_samples
+        self._counts = None
+
+    @property
+    def shape(self):
+        return self.packed.shape[0], self.n_samples
+
+    @classmethod
+    def from_array(cls, G):
+        """Packs genotypes coded as in read_bed"""
+        p, n = G.shape
+        bits = np.zeros((p, 4 * ((n + 3) // 4)), dtype=np.uint8)
+        bits[:, :n] = _BED_BITS[np.asarray(G, dtype=np.int8)]
+        bits <<= np.tile(np.arange(0, 8, 2, dtype=np.uint8), bits.shape[1] // 4)
+        packed = np.bitwise_or.reduce(bits.reshape((p, -1, 4)), axis=2)
+        return cls(packed, n)
+
+    def load(self):
+        return PackedGenotypes(np.array(self.packed), self.n_samples)
+
+    def unpack(self, variants=slice(None), samples=slice(None), dtype=np.int8):
+        """Genotypes of a block of variants (slice or positions) and of a slice of samples"""
+        start, stop, _ = samples.indices(self.n_samples)
+        lo, hi = start // 4, (stop + 3) // 4
+        G = _BYTE_GENOTYPES[np.asarray(self.packed[variants, lo:hi])]
+        G = G.reshape((G.shape[0], -1))[:, start - 4 * lo:stop - 4 * lo]
+        return G.astype(dtype, copy=False)
+
+    def iter_blocks(self, block_size=BLOCK_SIZE, dtype=np.int8, variants=None):
+        """Yields (first variant, genotypes) for consecutive blocks of variants, or of the variants at positions variants"""
+        p = self.packed.shape[0] if variants is None else len(variants)
+        for start in range(0, p, max(block_size, 1)):
+            block = slice(start, start + block_size)
+            yield start, self.unpack(block if variants is None else variants[block], dtype=dtype)
+
+    def take_variants(self, idx):
+        return PackedGenotypes(np.asarray(self.packed[idx]), self.n_samples)
+
+    def take_samples(self, idx, block_size=BLOCK_SIZE):
+        """The genotypes of the samples at positions idx, only reading the bytes that hold them"""
+        idx = np.asarray(idx)
+        if len(idx) == 0:
+            return PackedGenotypes(np.zeros((self.packed.shape[0], 0), dtype=np.uint8), 0)
+        lo, hi = idx.min(), idx.max() + 1
+        if lo % 4 == 0 and hi - lo == len(idx) and np.all(np.diff(idx) == 1):
+            # whole bytes, the bits after the last sample are ignored
+            return PackedGenotypes(np.array(self.packed[:, lo // 4:(hi + 3) // 4]), len(idx))
+        window = self.packed[:, lo // 4:(hi + 3) // 4]
+        cols = idx - 4 * (lo // 4)
+        blocks = []
+        for start in range(0, window.shape[0], block_size):
+            G = _BYTE_GENOTYPES[np.asarray(window[start:start + block_size])]
+            blocks.append(PackedGenotypes.from_array(G.reshape((G.shape[0], -1))[:, cols]).packed)
+        return PackedGenotypes(np.vstack(blocks), len(idx))
+
+    @property
+    def counts(self):
+        """Number of each genotype (0, 1, 2, missing) at each variant"""
+        if self._counts is None:
+            p, n_bytes = self.packed.shape
+            n_full = self.n_samples // 4
+            counts = np.zeros((p, 4), dtype=np.int64)
+            for start in range(0, p, BLOCK_SIZE):
+                rows = slice(start, start + BLOCK_SIZE)
+                full = np.asarray(self.packed[rows, :n_full])
+                for x in range(4):
+                    counts[rows, x] = _BYTE_COUNTS[full, x].sum(axis=1)
+                if n_full < n_bytes:
+                    tail = self.unpack(rows, slice(4 * n_full, self.n_samples))
+                    for x in range(4):
+                        counts[rows, x] += np.sum(tail == x, axis=1)
+            self._counts = counts
+        return self._counts
+
+    @property
+    def n_missing(self):
+        return self.counts[:, 3]
+
+    def mean_std(self):
+        """Mean and standard deviation of the non-missing genotypes of each variant, as computed by standardize"""
+        counts = self.counts
+        n_nomiss = counts[:, :3].sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (counts[:, 1] + 2 * counts[:, 2]) / n_nomiss
+            std = np.sqrt(np.maximum((counts[:, 1] + 4 * counts[:, 2]) / n_nomiss - mean ** 2, 0))
+        std[std == 0] = 1
+        return mean.reshape((-1, 1)), std.reshape((-1, 1))
+
+
+def open_bed(bed_filepref, n_variants, n_samples) -> PackedGenotypes:
+    """Memory-maps the genotypes of a SNP-major .bed file"""
+    with open(bed_filepref + '.bed', 'rb') as f:
+        if f.read(3) != b'\x6c\x1b\x01':
+            raise ValueError("{}.bed is not a SNP-major binary PLINK file".format(bed_filepref))
+    packed = np.memmap(bed_filepref + '.bed', dtype=np.uint8, mode='r', offset=3,
+                       shape=(n_variants, (n_samples + 3) // 4))
+    return PackedGenotypes(packed, n_samples)
@@ -0,0 +1,115 @@
+import logging
+import re
+from dataclasses import dataclass
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# Smallest number of variants standardized/accumulated at once, below which the per-block overhead dominates
+MIN_BLOCK_SIZE = 256
+# Study samples read and projected at once when no memory budget is given
+STUDY_CHUNK_SIZE = 1000
+# Study samples unpacked and standardized at once during the projection
+STUDY_BLOCK_SIZE = 16
+
+
+def parse_memory(memory) -> int:
+    """Parses a memory size like 16G, 500M or 2.5GB into bytes"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*', str(memory), flags=re.IGNORECASE)
+    if match is None:
+        raise ValueError("Can't parse memory size {} (use e.g. 16G or 500M)".format(memory))
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+def format_memory(n_bytes) -> str:
+    for unit in ['T', 'G', 'M', 'K']:
+        if n_bytes >= _UNITS[unit]:
+            return '{:.1f} {}iB'.format(n_bytes / _UNITS[unit], unit)
+    return '{} B'.format(int(n_bytes))
+
+
+@dataclass
+class MemoryPlan:
+    """
+    How the reference PCA and the study projection are split up to stay within a memory budget, with the
+    estimated peak memory (bytes) of each stage.
+    """
+    max_memory: int
+    ref_in_core: bool
+    ref_block_size: int
+    study_chunk_size: int
+    n_stu: int
+    estimates: dict[str, int]
+
+    def log(self):
+        n_chunks = -(-self.n_stu // self.study_chunk_size) if self.n_stu else 0
+        logging.info('Memory budget: {}'.format(format_memory(self.max_memory)))
+        logging.info('  Reference PCA (if not saved): {}, blocks of {} variants (estimated peak {})'.format(
+            'in-core' if self.ref_in_core else 'out-of-core', self.ref_block_size,
+            format_memory(self.estimates['reference PCA'])))
+        logging.info('  Study projection: {} chunk(s) of up to {} samples (estimated peak {})'.format(
+            n_chunks, self.study_chunk_size, format_memory(self.estimates['study projection'])))
+        for stage, n_bytes in self.estimates.items():
+            if n_bytes > self.max_memory:
+                logging.warning('Estimated peak memory of the {} stage ({}) exceeds the budget'.format(
+                    stage, format_memory(n_bytes)))
+
+
+def estimate_memory(method, n_variants, n_ref, dim_ref, dim_online=None, ref_in_core=True, ref_block_size=None,
+                    study_chunk_size=0) -> dict[str, int]:
+    """Estimated peak memory (bytes) of the reference PCA and the study projection"""
+    p, n = n_variants, n_ref
+    if ref_block_size is None:
+        ref_block_size = p
+    k = dim_online if method in ['oadp', 'randoadp'] else dim_ref
+    # covariance matrix, its eigenvectors and the LAPACK workspace
+    eig = 3 * 8 * n * n
+    loadings = 8 * p * k
+    # a block of unpacked genotypes: int8 codes, float32 copy and missingness mask
+    block = 6 * ref_block_size * n
+    if method in ['adp', 'randoadp']:
+        # float32 genotypes plus the missingness mask of one block in standardize
+        ref_pca = 4 * p * n + ref_block_size * n + eig + loadings
+    elif ref_in_core:
+        # packed genotypes, 4 per byte
+        ref_pca = p * n // 4 + block + eig + loadings
+    else:
+        ref_pca = block + eig + loadings
+    if method == 'adp':
+        # standardized reference genotypes and XTX are kept, and each sample decomposes an augmented XTX
+        model = 4 * p * n + 4 * n * n + eig
+    else:
+        model = loadings + 8 * n * k + 16 * p
+    # float64 working vectors of one sample and one block of unpacked, standardized samples, plus the chunks in
+    # flight (projected, queued and being prefetched)
+    study = model + 4 * 8 * p + STUDY_BLOCK_SIZE * 10 * p + study_chunk_size * _study_per_sample(p, dim_ref)
+    return {'reference PCA': ref_pca, 'study projection': study}
+
+
+def _study_per_sample(n_variants, dim_ref) -> int:
+    # up to three chunks of packed genotypes, and the PC scores and genotype hash
+    return 3 * (n_variants // 4 + 1) + 8 * dim_ref + 32
+
+
+def plan_memory(max_memory, method, n_variants, n_ref, n_stu, dim_ref, dim_online=None) -> MemoryPlan:
+    """Picks the reference PCA mode, variant block size and study chunk size that fit in max_memory bytes"""
+    p, n = n_variants, n_ref
+    min_block = min(p, MIN_BLOCK_SIZE)
+
+    def ref_memory(in_core, block_size):
+        return estimate_memory(method, p, n, dim_ref, dim_online, in_core, block_size)['reference PCA']
+
+    # oadp/sp only need the top PCs and can stream the reference in blocks; the others need all genotypes
+    out_of_core_ok = method in ['oadp', 'sp']
+    ref_in_core = ref_memory(True, min_block) <= max_memory or not out_of_core_ok
+    fixed = ref_memory(ref_in_core, 0)
+    per_variant = 6 * n if out_of_core_ok else n
+    block_size = (max_memory - fixed) // per_variant if n else p
+    block_size = int(min(p, max(min_block, block_size)))
+
+    fixed = estimate_memory(method, p, n, dim_ref, dim_online)['study projection']
+    per_sample = _study_per_sample(p, dim_ref)
+    chunk_size = int(min(max(n_stu, 1), max(1, (max_memory - fixed) // per_sample)))
+
+    estimates = estimate_memory(method, p, n, dim_ref, dim_online, ref_in_core, block_size, chunk_size)
+    return MemoryPlan(max_memory=max_memory, ref_in_core=ref_in_core, ref_block_size=block_size,
+                      study_chunk_size=chunk_size, n_stu=n_stu, estimates=estimates)
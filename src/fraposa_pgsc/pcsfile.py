@@ -0,0 +1,109 @@
+import os
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+
+from fraposa_pgsc.refcache import atomic_write, load_array
+
+# Files written for each --output_format
+OUTPUT_FORMATS = {'tsv': ('tsv',), 'npy': ('npy',), 'both': ('tsv', 'npy')}
+
+
+def _paths(filepref):
+    return {'tsv': [filepref + '.pcs'], 'npy': [filepref + '.pcs.npy', filepref + '.pcs.ids']}
+
+
+def pcs_ids(fam) -> pd.DataFrame:
+    """The FID and IID columns written for the samples of a PyPlink fam"""
+    ids = pd.DataFrame({'FID': fam['fid'].astype(str).to_numpy(), 'IID': fam['iid'].astype(str).to_numpy()})
+    # FID is always a string
+    if all(ids['FID'] == "0"):
+        # column is present but missing data
+        ids['FID'] = ids['IID']
+    return ids
+
+
+class PcsWriter:
+    """
+    Writes the PC scores of the samples in fam, in order, as blocks of rows are computed: to {filepref}.pcs
+    (tab-separated FID, IID and PC columns) and/or to {filepref}.pcs.npy (float64 array) with the FIDs and IIDs in
+    {filepref}.pcs.ids.
+
+    The files are renamed into place by close(), so a failed run leaves no partial output. Files of the formats
+    that aren't written are removed, so load_pcs never reads stale PC scores.
+    """
+    def __init__(self, filepref, fam, colnames, formats=('tsv',), output_fmt='%.4f'):
+        self.filepref = filepref
+        self.colnames = list(colnames)
+        self.formats = formats
+        self.output_fmt = output_fmt
+        self.ids = pcs_ids(fam)
+        self.n_written = 0
+        self._files = {}
+        self._stack = ExitStack()
+        if 'tsv' in formats:
+            f = self._files['tsv'] = self._stack.enter_context(atomic_write(filepref + '.pcs'))
+            f.write('\t'.join(['FID', 'IID'] + self.colnames) + '\n')
+        if 'npy' in formats:
+            self.ids.to_csv(self._stack.enter_context(atomic_write(filepref + '.pcs.ids')), sep='\t', header=True,
+                            index=False)
+            f = self._files['npy'] = self._stack.enter_context(atomic_write(filepref + '.pcs.npy', 'wb'))
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+                                                     'fortran_order': False,
+                                                     'shape': (len(self.ids), len(self.colnames))})
+
+    @property
+    def paths(self):
+        return [path for x in self.formats for path in _paths(self.filepref)[x]]
+
+    def write(self, start, pcs):
+        """Writes the PC scores of samples start to start + len(pcs)"""
+        assert start == self.n_written, "PC scores must be written in sample order"
+        stop = start + len(pcs)
+        assert stop <= len(self.ids)
+        if 'tsv' in self._files:
+            rows = self.ids.iloc[start:stop].reset_index(drop=True)
+            rows[self.colnames] = np.asarray(pcs)
+            rows.to_csv(self._files['tsv'], sep='\t', header=False, index=False, float_format=self.output_fmt)
+        if 'npy' in self._files:
+            self._files['npy'].write(np.ascontiguousarray(pcs, dtype=np.float64).tobytes())
+        self.n_written = stop
+
+    def close(self):
+        if self.n_written != len(self.ids):
+            error = ValueError("Missing PC scores of {} samples in {}".format(len(self.ids) - self.n_written,
+                                                                            self.filepref))
+            # removes the temporary files
+            self._stack.__exit__(ValueError, error, None)
+            raise error
+        self._stack.close()
+        for x in OUTPUT_FORMATS['both']:
+            if x not in self.formats:
+                for path in _paths(self.filepref)[x]:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stack.__exit__(exc_type, exc, tb)
+
+
+def load_pcs(filepref):
+    """
+    The FIDs and IIDs (FID and IID columns) and the PC scores saved by PcsWriter, memory-mapping {filepref}.pcs.npy
+    if it was written and reading {filepref}.pcs otherwise
+    """
+    if os.path.exists(filepref + '.pcs.npy') and os.path.exists(filepref + '.pcs.ids'):
+        ids = pd.read_csv(filepref + '.pcs.ids', sep='\t', dtype=str)
+        pcs = load_array(filepref + '.pcs.npy')
+    else:
+        df = pd.read_csv(filepref + '.pcs', sep='\t', dtype={'FID': str, 'IID': str})
+        ids, pcs = df[['FID', 'IID']], df.iloc[:, 2:].to_numpy()
+    assert len(ids) == len(pcs)
+    return ids, pcs
@@ -0,0 +1,47 @@
+import queue
+import threading
+
+_END = object()
+
+
+def prefetch(iterable, depth=1):
+    """
+    Iterates over iterable in a background thread, keeping up to depth items ready ahead of the consumer.
+
+    Exceptions raised by the iterable are re-raised in the consumer. Closing the generator early stops the thread.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((_END, e))
+            return
+        put((_END, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
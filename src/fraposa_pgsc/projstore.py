@@ -0,0 +1,97 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from fraposa_pgsc.refcache import atomic_write, file_lock, load_array, save_array
+
+
+def hash_samples(G) -> np.ndarray:
+    """Hash of the (int8) genotypes of each sample (column) of G, a genotype array or PackedGenotypes"""
+    blocks = [G] if isinstance(G, np.ndarray) else (block for _, block in G.iter_blocks())
+    hashes = [hashlib.blake2b(digest_size=16) for _ in range(G.shape[1])]
+    for block in blocks:
+        for h, g in zip(hashes, np.ascontiguousarray(block.T, dtype=np.int8)):
+            h.update(g)
+    return np.array([h.hexdigest() for h in hashes], dtype='S32')
+
+
+class ProjectionStore:
+    """
+    Study PC scores saved from previous runs ({filepref}_pcs.npy), keyed by a hash of each sample's genotypes
+    ({filepref}_hashes.npy).
+
+    The key ({filepref}_store.json) records the reference model (a fingerprint of the saved reference PCA result)
+    and the PCA parameters the scores were computed with. Stored scores are only reused when both match; otherwise
+    the store is replaced by the next save. Like the ReferenceCache, jobs sharing a store coordinate through a file
+    lock ({filepref}_store.lock), so shards of a study can be projected into the same store.
+    """
+    def __init__(self, filepref, model: str, params: dict):
+        self.filepref = filepref
+        self.model = model
+        self.params = params
+        self.key_path = filepref + '_store.json'
+        self.hashes_path = filepref + '_hashes.npy'
+        self.pcs_path = filepref + '_pcs.npy'
+        self.lock_path = filepref + '_store.lock'
+        self._set(None)
+
+    def lock(self, exclusive=True):
+        return file_lock(self.lock_path, exclusive)
+
+    def _read(self, quiet=False):
+        """The saved hashes and PC scores if they are valid for this model and these parameters"""
+        log = logging.debug if quiet else logging.info
+        try:
+            with open(self.key_path, 'r') as f:
+                key = json.load(f)
+            hashes, pcs = load_array(self.hashes_path), np.asarray(load_array(self.pcs_path))
+        except (OSError, ValueError):
+            return None
+        if key['model'] != self.model or key['params'] != self.params:
+            log('Stored study PC scores in {} were computed with a different reference model or '
+                         'parameters, they will be replaced.'.format(self.filepref))
+            return None
+        if len(hashes) != key['n_samples'] or len(pcs) != key['n_samples']:
+            log('Stored study PC scores in {} are incomplete, they will be replaced.'.format(self.filepref))
+            return None
+        return hashes, pcs
+
+    def load(self):
+        with self.lock(exclusive=False):
+            self._set(self._read())
+        logging.info('Loaded {} stored study PC scores from {}.'.format(len(self.hashes), self.filepref))
+        return self
+
+    def _set(self, saved):
+        if saved is None:
+            saved = np.zeros(0, dtype='S32'), np.zeros((0, self.params['dim_ref']))
+        self.hashes, self.pcs = saved
+        self._index = {h: i for i, h in enumerate(self.hashes.tolist())}
+
+    def lookup(self, hashes) -> np.ndarray:
+        """Row of each hash in the store, or -1 for samples that haven't been projected yet"""
+        return np.array([self._index.get(h, -1) for h in hashes.tolist()], dtype=np.int64)
+
+    def save(self, hashes, pcs):
+        """Adds the PC scores of samples that aren't in the store yet, merging with scores saved in the meantime"""
+        with self.lock(exclusive=True):
+            saved = self._read(quiet=True)
+            self._set(saved)
+            new = self.lookup(hashes) < 0
+            # a study can contain samples with identical genotypes
+            _, first = np.unique(hashes[new], return_index=True)
+            new = np.flatnonzero(new)[np.sort(first)]
+            if len(new) == 0 and saved is not None:
+                return
+            self.hashes = np.concatenate((self.hashes, hashes[new]))
+            self.pcs = np.vstack((self.pcs, pcs[new]))
+            if os.path.exists(self.key_path):
+                os.remove(self.key_path)
+            save_array(self.hashes_path, self.hashes)
+            save_array(self.pcs_path, self.pcs)
+            with atomic_write(self.key_path) as f:
+                json.dump({'model': self.model, 'params': self.params, 'n_samples': len(self.hashes)}, f, indent=2)
+        logging.info('Stored the PC scores of {} new study samples in {}.'.format(len(new), self.filepref))
@@ -0,0 +1,151 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+PLINK_SUFFIXES = ('.bed', '.bim', '.fam')
+
+
+def fingerprint_files(paths, chunk_size=1 << 24) -> str:
+    """Hash of the contents of a list of files"""
+    h = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint_plink(filepref) -> dict:
+    """Fingerprint of a binary PLINK fileset, with file sizes and modification times to skip rehashing"""
+    paths = [filepref + suff for suff in PLINK_SUFFIXES]
+    return {'fingerprint': fingerprint_files(paths), 'stats': _file_stats(paths)}
+
+
+def _file_stats(paths) -> list[list[int]]:
+    return [[os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in paths]
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Writes to a temporary file next to path, then renames it into place once the write has succeeded"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path) + '.', suffix='.tmp')
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)  # mkstemp creates files readable by the owner only
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_array(path, arr):
+    with atomic_write(path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(arr))
+
+
+def load_array(path):
+    """Memory-maps a saved array read-only. Files are replaced atomically, so the map stays valid after rewrites"""
+    return np.load(path, mmap_mode='r')
+
+
+@contextmanager
+def file_lock(path, exclusive=True):
+    """Holds an exclusive or shared lock on path (created if needed) for the duration of the block"""
+    try:
+        f = open(path, 'a')
+    except OSError:
+        # e.g. a reference shared from a read-only directory, where nothing can be written anyway
+        logging.warning('Cannot create {}, continuing without locking.'.format(path))
+        yield
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ReferenceCache:
+    """
+    The saved reference PCA result ({ref_filepref}_*.dat and {ref_filepref}.pcs*) and the key it was computed with.
+
+    The key ({ref_filepref}_cache.json) records a fingerprint of the reference .bed/.bim/.fam and the PCA parameters.
+    A saved result is only reused when both match. Jobs sharing a reference coordinate through a file lock
+    ({ref_filepref}_cache.lock): readers hold a shared lock, the job computing the result holds an exclusive lock.
+    """
+    def __init__(self, ref_filepref, params: dict = None):
+        self.ref_filepref = ref_filepref
+        self.params = params
+        self.key_path = ref_filepref + '_cache.json'
+        self.lock_path = ref_filepref + '_cache.lock'
+
+    @contextmanager
+    def lock(self, exclusive=True):
+        with file_lock(self.lock_path, exclusive):
+            yield self
+
+    def read_key(self):
+        try:
+            with open(self.key_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def model_fingerprint(self):
+        """Fingerprint of the saved result (reference genotypes, samples folded in since, parameters), if any"""
+        key = self.read_key()
+        if key is None:
+            return None
+        model = {'reference': key['reference']['fingerprint'], 'params': key['params'],
+                 'updates': [update['fingerprint'] for update in key['updates']]}
+        return hashlib.blake2b(json.dumps(model, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def is_valid(self, quiet=False) -> bool:
+        key = self.read_key()
+        log = logging.debug if quiet else logging.info
+        if key is None:
+            log('No saved REFERENCE PCA result found for {}.'.format(self.ref_filepref))
+            return False
+        if key['params'] != self.params:
+            changed = sorted(x for x in self.params if key['params'].get(x) != self.params[x])
+            log('Saved REFERENCE PCA result was computed with different parameters ({}).'.format(
+                ', '.join(changed)))
+            return False
+        if not self.reference_unchanged(key['reference']):
+            log('Reference genotypes have changed since the saved REFERENCE PCA result was computed.')
+            return False
+        return True
+
+    def reference_unchanged(self, reference) -> bool:
+        paths = [self.ref_filepref + suff for suff in PLINK_SUFFIXES]
+        if not all(os.path.exists(path) for path in paths):
+            logging.warning('Reference genotypes for {} not found, the saved REFERENCE PCA result '
+                            'cannot be checked against them.'.format(self.ref_filepref))
+            return True
+        if _file_stats(paths) == reference['stats']:
+            return True
+        return fingerprint_files(paths) == reference['fingerprint']
+
+    def invalidate(self):
+        if os.path.exists(self.key_path):
+            os.remove(self.key_path)
+
+    def commit(self, reference=None, updates=()):
+        """Records the saved result as complete. Call after all of its files have been written"""
+        if reference is None:
+            reference = fingerprint_plink(self.ref_filepref)
+        key = {'reference': reference, 'updates': list(updates), 'params': self.params}
+        with atomic_write(self.key_path) as f:
+            json.dump(key, f, indent=2)
@@ -0,0 +1,35 @@
+import fraposa_pgsc.fraposa as fp
+from fraposa_pgsc.fraposa_runner import add_pca_arguments, pca_kwargs
+import argparse
+
+
+def plan_main():
+    parser = argparse.ArgumentParser(description='Plan shards of study samples to be projected independently (e.g. on different nodes).')
+    parser.add_argument('stu_filepref', help='Prefix of the binary PLINK file for the study samples.')
+    parser.add_argument('n_shards', help='Number of shards to split the study samples into.')
+    parser.add_argument('--out', help='Prefix of the shard plan ({out}_shards.json) and of the partial results. Default is stu_filepref')
+    args = parser.parse_args()
+
+    fp.plan_shards(args.stu_filepref, int(args.n_shards), plan_filepref=args.out)
+
+
+def run_main():
+    parser = argparse.ArgumentParser(description='Project the study samples of one planned shard.')
+    parser.add_argument('ref_filepref', help='Prefix of the binary PLINK file for the reference samples.')
+    parser.add_argument('plan_filepref', help='Prefix of the shard plan (the --out of fraposa_shard).')
+    parser.add_argument('shard', help='Index of the shard to project, from 0 to n_shards - 1.')
+    add_pca_arguments(parser)
+    parser.add_argument('--out', help='Prefix of output file(s). Default is {plan_filepref}_shard{shard}, which is where fraposa_merge looks for it.')
+    args = parser.parse_args()
+
+    fp.run_shard(args.ref_filepref, args.plan_filepref, int(args.shard), out_filepref=args.out, **pca_kwargs(args))
+
+
+def merge_main():
+    parser = argparse.ArgumentParser(description='Check that every planned shard has been projected and merge the PC scores.')
+    parser.add_argument('plan_filepref', help='Prefix of the shard plan (the --out of fraposa_shard).')
+    parser.add_argument('--out', help='Prefix of the merged output ({out}.pcs). Default is the study prefix.')
+    parser.add_argument('--output_format', choices=['tsv', 'npy', 'both'], default='tsv', help='Format of the merged PC scores, as in fraposa. Default is tsv.')
+    args = parser.parse_args()
+
+    fp.merge_shards(args.plan_filepref, out_filepref=args.out, output_format=args.output_format)
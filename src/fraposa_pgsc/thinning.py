@@ -0,0 +1,61 @@
+import logging
+
+import numpy as np
+
+from fraposa_pgsc.genotypes import BLOCK_SIZE, PackedGenotypes
+
+
+def maf(X: PackedGenotypes) -> np.ndarray:
+    """Minor allele frequency of each variant among the non-missing genotypes"""
+    counts = X.counts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        freq = (counts[:, 1] + 2 * counts[:, 2]) / (2 * counts[:, :3].sum(axis=1))
+    return np.nan_to_num(np.minimum(freq, 1 - freq))
+
+
+def ld_band(X: PackedGenotypes, chrom, window, block_size=BLOCK_SIZE) -> np.ndarray:
+    """
+    Squared correlations between each variant and the window variants before it on the same chromosome, with
+    missing genotypes imputed to the mean: r2[i, d - 1] is the r^2 between variants i and i - d
+    """
+    p, n = X.shape
+    mean, std = X.mean_std()
+    chrom = np.asarray(chrom)
+    r2 = np.zeros((p, window), dtype=np.float32)
+    for start in range(0, p, block_size):
+        lo = max(0, start - window)
+        stop = min(p, start + block_size)
+        Z = X.unpack(slice(lo, stop), dtype=np.float32)
+        is_miss = Z == 3
+        Z -= mean[lo:stop]
+        Z /= std[lo:stop]
+        Z[is_miss] = 0
+        for d in range(1, window + 1):
+            first = max(start, d)
+            if first >= stop:
+                break
+            r = np.einsum('ij,ij->i', Z[first - lo:stop - lo], Z[first - d - lo:stop - d - lo]) / n
+            same_chrom = chrom[first:stop] == chrom[first - d:stop - d]
+            r2[first:stop, d - 1] = np.where(same_chrom, np.square(r), 0)
+    return r2
+
+
+def thin_variants(X: PackedGenotypes, bim, min_maf=None, ld_r2=None, ld_window=50) -> np.ndarray:
+    """
+    Which variants to keep: those with a minor allele frequency of at least min_maf and, scanning each chromosome in
+    .bim order, not in LD (r^2 > ld_r2) with a variant kept among the ld_window variants before them
+    """
+    p = X.shape[0]
+    keep = np.ones(p, dtype=bool)
+    if min_maf is not None:
+        keep &= maf(X) >= min_maf
+        logging.info('{} out of {} reference variants have a MAF of at least {}.'.format(np.sum(keep), p, min_maf))
+    if ld_r2 is not None:
+        logging.info('Pruning variants in LD (r^2 > {}) within windows of {} variants...'.format(ld_r2, ld_window))
+        r2 = ld_band(X, bim['chrom'], ld_window)
+        for i in range(p):
+            if keep[i]:
+                d = np.flatnonzero(r2[i] > ld_r2) + 1
+                keep[i] = not np.any(keep[i - d])
+    logging.info('Kept {} out of {} reference variants after thinning.'.format(np.sum(keep), p))
+    return keep
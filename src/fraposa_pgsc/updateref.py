@@ -0,0 +1,27 @@
+import fraposa_pgsc.fraposa as fp
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ref_filepref', help='Prefix of the binary PLINK file for the reference samples. The saved reference PCA result (oadp) must already exist.')
+    parser.add_argument('new_filepref', help='Prefix of the binary PLINK file for the samples to add to the reference.')
+    parser.add_argument('--dim_ref', help='Number of PCs in the drift report, at most the dim_stu of the saved reference PCA result. Default is the dim_ref of the saved reference PCA result.')
+    parser.add_argument('--batch_size', help='Number of new samples added per SVD update. Default is 256.')
+    parser.add_argument('--drift', action='store_true', help='Refit the combined reference from scratch and report how far the incremental result has drifted from it.')
+    parser.add_argument('--out', help='Prefix of the updated reference PCA result. Default is ref_filepref (update in place).')
+    args = parser.parse_args()
+
+    dim_ref = None
+    batch_size = 256
+    if args.dim_ref:
+        dim_ref = int(args.dim_ref)
+    if args.batch_size:
+        batch_size = int(args.batch_size)
+
+    fp.update_ref(ref_filepref=args.ref_filepref, new_filepref=args.new_filepref, out_filepref=args.out,
+                  dim_ref=dim_ref, batch_size=batch_size, check_drift=args.drift)
+
+
+if __name__ == '__main__':
+    main()
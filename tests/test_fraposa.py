@@ -1,12 +1,22 @@
 import csv
+import json
 import os
 import shutil
 from unittest.mock import patch
 
+import numpy as np
 import pandas as pd
 import pytest
 
+from fraposa_pgsc.fraposa import (_count_lines, _pooled_mnsd, oadp, read_bed, ref_aug_procrustes, standardize,
+                                  svd_online, svd_update)
+from fraposa_pgsc.genotypes import PackedGenotypes, open_bed
 from fraposa_pgsc.fraposa_runner import main
+from fraposa_pgsc.memplan import parse_memory, plan_memory
+from fraposa_pgsc.pcsfile import PcsWriter, load_pcs
+from fraposa_pgsc.prefetch import prefetch
+from fraposa_pgsc.thinning import thin_variants
+from fraposa_pgsc import plotpcs, predstupopu, shardrunner, updateref
 
 
 @pytest.fixture(scope="session")
@@ -85,6 +95,384 @@ def test_fraposa(ref_data, filt_id, args):
     assert _output_exists(ref_data), "Missing output files"
 
 
+def test_update_ref(ref_data):
+    """ Adding samples to a saved reference model writes an updated model and a drift report """
+    cwd = os.getcwd()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa', "thousand_comm"]):
+        main()
+    with patch('sys.argv', ['fraposa_update_ref', "thousand_comm", "example_comm", "--out", "thousand_updated",
+                            "--drift"]):
+        updateref.main()
+    os.chdir(cwd)
+
+    pcs = pd.read_table(ref_data / "thousand_updated.pcs")
+    assert pcs.shape == (2492 + 500, 6)
+    drift = pd.read_table(ref_data / "thousand_updated_drift.tsv")
+    # the trailing PCs are closer to noise and drift further
+    assert all(drift["abs_corr"].iloc[:2] > 0.99)
+    assert all(drift["abs_corr"] > 0.95)
+
+
+def test_shuffled_study_variants(ref_data):
+    """ A study with its variants in a different order to the reference gets the same PC scores """
+    n_bytes = (500 + 3) // 4
+    with open(ref_data / "example_comm.bed", "rb") as f:
+        magic, rows = f.read(3), f.read()
+    bim = pd.read_table(ref_data / "example_comm.bim", header=None, dtype=str)
+    order = np.random.default_rng(42).permutation(len(bim))
+    packed = np.frombuffer(rows, dtype=np.uint8).reshape((len(bim), n_bytes))[order]
+    with open(ref_data / "example_shuffled.bed", "wb") as f:
+        f.write(magic + packed.tobytes())
+    bim.iloc[order].to_csv(ref_data / "example_shuffled.bim", sep="\t", header=False, index=False)
+    shutil.copy(ref_data / "example_comm.fam", ref_data / "example_shuffled.fam")
+
+    cwd = os.getcwd()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_shuffled", "thousand_comm"]):
+        main()
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_ordered"]):
+        main()
+    os.chdir(cwd)
+
+    shuffled = pd.read_table(ref_data / "example_shuffled.pcs")
+    ordered = pd.read_table(ref_data / "example_ordered.pcs")
+    pd.testing.assert_frame_equal(shuffled, ordered)
+
+
+def test_update_ref_in_place(tmp_path_factory):
+    """ An in-place update keeps the saved dimensions, and the added samples are never silently refitted away """
+    fn = tmp_path_factory.mktemp("update")
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "data"), str(fn), dirs_exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(fn)
+    try:
+        with patch('sys.argv', ['fraposa', "thousand_comm", "--dim_ref", "2"]):
+            main()
+        with patch('sys.argv', ['fraposa_update_ref', "thousand_comm", "example_comm"]):
+            updateref.main()
+        with open("thousand_comm_cache.json") as f:
+            assert json.load(f)["params"]["dim_ref"] == 2
+        with patch('sys.argv', ['fraposa', "thousand_comm", "--dim_ref", "2", "--stu_filepref", "example_comm"]):
+            main()
+        assert len(pd.read_table("thousand_comm.pcs")) == 2492 + 500
+        with pytest.raises(ValueError) as excinfo:
+            with patch('sys.argv', ['fraposa', "thousand_comm", "--dim_ref", "3"]):
+                main()
+        assert "fraposa_update_ref" in str(excinfo.value)
+    finally:
+        os.chdir(cwd)
+
+
+def test_shards(ref_data):
+    """ Projecting planned shards separately and merging them gives the same result as one run """
+    cwd = os.getcwd()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa_shard', "example_comm", "3", "--out", "example_plan"]):
+        shardrunner.plan_main()
+    with patch('sys.argv', ['fraposa_merge', "example_plan", "--out", "example_merged"]):
+        with pytest.raises(ValueError) as excinfo:
+            shardrunner.merge_main()
+    assert "0, 1, 2" in str(excinfo.value)
+
+    # shards can run from another working directory, e.g. on other nodes
+    os.makedirs("shard_workdir", exist_ok=True)
+    os.chdir("shard_workdir")
+    for shard in ["0", "1", "2"]:
+        with patch('sys.argv', ['fraposa_run_shard', "../thousand_comm", "../example_plan", shard]):
+            shardrunner.run_main()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa_merge', "example_plan", "--out", "example_merged"]):
+        shardrunner.merge_main()
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_whole"]):
+        main()
+    # a shard projected with other parameters isn't merged
+    with patch('sys.argv', ['fraposa_run_shard', "thousand_comm", "example_plan", "1", "--precision", "float32"]):
+        shardrunner.run_main()
+    with patch('sys.argv', ['fraposa_merge', "example_plan", "--out", "example_mixed"]):
+        with pytest.raises(ValueError) as excinfo:
+            shardrunner.merge_main()
+    os.chdir(cwd)
+
+    assert "different reference model or parameters" in str(excinfo.value)
+
+    merged = pd.read_table(ref_data / "example_merged.pcs")
+    whole = pd.read_table(ref_data / "example_whole.pcs")
+    pd.testing.assert_frame_equal(merged, whole)
+
+
+def test_shards_duplicate_iid(ref_data):
+    """ Merging checks the FIDs as well as the IIDs, which can be duplicated """
+    cwd = os.getcwd()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa_shard', "dup_test", "2", "--out", "dup_plan"]):
+        shardrunner.plan_main()
+    for shard in ["0", "1"]:
+        with patch('sys.argv', ['fraposa_run_shard', "thousand_comm", "dup_plan", shard]):
+            shardrunner.run_main()
+    shutil.copy("dup_plan_shard0.pcs", "dup_plan_shard0.pcs.orig")
+    # same IIDs, different FIDs
+    shutil.copy("dup_plan_shard1.pcs", "dup_plan_shard0.pcs")
+    with patch('sys.argv', ['fraposa_merge', "dup_plan", "--out", "dup_merged"]):
+        with pytest.raises(ValueError) as excinfo:
+            shardrunner.merge_main()
+    shutil.copy("dup_plan_shard0.pcs.orig", "dup_plan_shard0.pcs")
+    with patch('sys.argv', ['fraposa_merge', "dup_plan", "--out", "dup_merged"]):
+        shardrunner.merge_main()
+    os.chdir(cwd)
+
+    assert "does not contain samples 1 to 250" in str(excinfo.value)
+    merged = pd.read_table(ref_data / "dup_merged.pcs", dtype=str)
+    fam = pd.read_table(ref_data / "dup_test.fam", header=None, dtype=str)
+    assert list(merged["FID"]) == list(fam[0])
+
+
+def test_max_memory(ref_data):
+    """ A memory budget splits the study into chunks without changing the PC scores """
+    cwd = os.getcwd()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_budget",
+                            "--max_memory", "10M"]):
+        main()
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_whole"]):
+        main()
+    with open("example_budget.log") as f:
+        log = f.read()
+    os.chdir(cwd)
+
+    assert "Finished 500 out of 500 study samples" in log
+    merged = pd.read_table(ref_data / "example_budget.pcs")
+    whole = pd.read_table(ref_data / "example_whole.pcs")
+    pd.testing.assert_frame_equal(merged, whole)
+
+
+def test_projection_store(ref_data, filt_id):
+    """ Rerunning with a projection store only projects the samples that weren't stored yet """
+    cwd = os.getcwd()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_subset",
+                            "--stu_filt_iid", filt_id, "--projection_store", "example_store"]):
+        main()
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_stored",
+                            "--projection_store", "example_store"]):
+        main()
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_plain"]):
+        main()
+    with open("example_stored.log") as f:
+        log = f.read()
+    os.chdir(cwd)
+
+    assert "Reused the stored PC scores of 100 out of 500 study samples" in log
+    stored = pd.read_table(ref_data / "example_stored.pcs")
+    plain = pd.read_table(ref_data / "example_plain.pcs")
+    pd.testing.assert_frame_equal(stored, plain)
+
+
+def test_precision(ref_data):
+    """ Projecting in float32 checks itself against float64 and gives the same PC scores to the written precision """
+    cwd = os.getcwd()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_float32",
+                            "--precision", "float32"]):
+        main()
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_float64"]):
+        main()
+    with open("example_float32.log") as f:
+        log = f.read()
+    os.chdir(cwd)
+
+    assert "Largest deviation from float64 in 20 re-projected study samples" in log
+    assert "consider using --precision float64" not in log
+    float32 = pd.read_table(ref_data / "example_float32.pcs")
+    float64 = pd.read_table(ref_data / "example_float64.pcs")
+    pd.testing.assert_frame_equal(float32, float64, check_exact=False, atol=1e-3)
+
+
+def test_thinning(tmp_path_factory):
+    """ Thinning fits the reference on a subset of the variants, reads only those from the study and reports how
+    close its PCs are to those of all the variants """
+    fn = tmp_path_factory.mktemp("thinning")
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "data"), str(fn), dirs_exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(fn)
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_thin",
+                            "--min_maf", "0.05", "--ld_r2", "0.02", "--ld_window", "20"]):
+        main()
+    os.chdir(cwd)
+
+    with open(fn / "thousand_comm_vars.dat") as f:
+        n_kept = len(f.read().strip().split("\n"))
+    with open(fn / "thousand_comm.bim") as f:
+        n_all = len(f.readlines())
+    assert 0 < n_kept < n_all
+    report = pd.read_table(fn / "thousand_comm_thin.tsv")
+    assert list(report["PC"]) == ["PC1", "PC2", "PC3", "PC4"]
+    assert report["abs_corr"].iloc[0] > 0.95
+    assert len(pd.read_table(fn / "example_thin.pcs")) == 500
+
+
+def test_thin_variants():
+    """ Of two identical variants only the first is kept, and rare variants are dropped """
+    rng = np.random.default_rng(42)
+    G = rng.integers(0, 3, size=(6, 200)).astype(np.int8)
+    G[3] = G[2]
+    G[5] = 0
+    G[5, 0] = 1
+    bim = pd.DataFrame({'chrom': [1, 1, 1, 1, 2, 2]})
+    keep = thin_variants(PackedGenotypes.from_array(G), bim, min_maf=0.01, ld_r2=0.5, ld_window=3)
+    np.testing.assert_array_equal(keep, [True, True, True, False, True, False])
+
+
+def test_output_format(ref_data):
+    """ Binary PC scores match the text ones and are read by the ancestry prediction and plot """
+    cwd = os.getcwd()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_npy",
+                            "--output_format", "npy"]):
+        main()
+    with patch('sys.argv', ['fraposa', "--stu_filepref", "example_comm", "thousand_comm", "--out", "example_text"]):
+        main()
+    ref_ids, pcs_ref = load_pcs("thousand_comm")
+    popu = ref_ids.assign(popu=np.where(pcs_ref[:, 0] > 0, "A", "B"))
+    popu.to_csv("thousand_comm.popu", sep="\t", header=False, index=False)
+    with patch('sys.argv', ['fraposa_pred', "thousand_comm", "example_npy"]):
+        predstupopu.main()
+    with patch('sys.argv', ['fraposa_plot', "thousand_comm", "example_npy"]):
+        plotpcs.main()
+    os.chdir(cwd)
+
+    assert not (ref_data / "example_npy.pcs").exists()
+    ids, pcs = load_pcs(str(ref_data / "example_npy"))
+    text = pd.read_table(ref_data / "example_text.pcs", dtype={"FID": str, "IID": str})
+    pd.testing.assert_frame_equal(ids, text[["FID", "IID"]])
+    np.testing.assert_allclose(pcs, text.iloc[:, 2:].to_numpy(), atol=1e-4)
+    pred = pd.read_table(ref_data / "example_npy.popu", header=None)
+    assert len(pred) == 500 and set(pred[2]) <= {"A", "B"}
+    assert (ref_data / "example_npy.png").exists()
+
+
+def test_pcs_writer(tmp_path):
+    """ Incomplete PC scores are not written, and no temporary files are left behind """
+    fam = pd.DataFrame({'fid': ["0", "0", "0"], 'iid': ["a", "b", "c"]})
+    with pytest.raises(ValueError, match="Missing PC scores of 1 samples"):
+        with PcsWriter(str(tmp_path / "out"), fam, ["PC1", "PC2"], formats=("tsv", "npy")) as writer:
+            writer.write(0, np.ones((2, 2)))
+    assert os.listdir(tmp_path) == []
+
+    with PcsWriter(str(tmp_path / "out"), fam, ["PC1", "PC2"], formats=("tsv", "npy")) as writer:
+        writer.write(0, np.ones((2, 2)))
+        writer.write(2, np.zeros((1, 2)))
+    ids, pcs = load_pcs(str(tmp_path / "out"))
+    assert list(ids["FID"]) == ["a", "b", "c"]
+    np.testing.assert_array_equal(pcs, [[1, 1], [1, 1], [0, 0]])
+
+
+def test_plan_memory():
+    """ The reference is streamed when it doesn't fit and the study chunks shrink with the budget """
+    assert parse_memory("1.5G") == 1.5 * 1024 ** 3
+    p, n_ref, n_stu = 600_000, 2500, 2_000
+    roomy = plan_memory(parse_memory("64G"), "oadp", p, n_ref, n_stu, dim_ref=4, dim_online=16)
+    assert roomy.ref_in_core and roomy.study_chunk_size == n_stu
+    tight = plan_memory(parse_memory("512M"), "oadp", p, n_ref, n_stu, dim_ref=4, dim_online=16)
+    assert not tight.ref_in_core and tight.study_chunk_size < n_stu
+    assert all(x <= parse_memory("512M") for x in tight.estimates.values())
+
+
+def test_count_lines(ref_data):
+    """ Only the header of the fallback .pcs is excluded from the number of reference samples """
+    fam = str(ref_data / "thousand_comm.fam")
+    assert _count_lines(fam, str(ref_data / "missing.pcs"), fallback_header=True) == 2492
+    assert _count_lines(str(ref_data / "missing.fam"), fam, fallback_header=True) == 2491
+
+
+def test_reference_cache(ref_data):
+    """ Saved reference results are reused with the same parameters and recomputed when they change """
+    cwd = os.getcwd()
+    os.chdir(ref_data)
+    with patch('sys.argv', ['fraposa', "thousand_comm"]):
+        main()
+    mtime = os.stat("thousand_comm_U.dat").st_mtime_ns
+    with patch('sys.argv', ['fraposa', "thousand_comm"]):
+        main()
+    assert os.stat("thousand_comm_U.dat").st_mtime_ns == mtime, "Valid reference result was recomputed"
+
+    with patch('sys.argv', ['fraposa', "thousand_comm", "--dim_ref", "2"]):
+        main()
+    with open("thousand_comm_cache.json") as f:
+        assert json.load(f)["params"]["dim_ref"] == 2
+    pcs = pd.read_table("thousand_comm.pcs")
+    os.chdir(cwd)
+
+    assert list(pcs.columns) == ["FID", "IID", "PC1", "PC2"]
+
+
+def test_pooled_mnsd():
+    """ Pooled means and standard deviations match those of the combined samples, including monomorphic variants """
+    rng = np.random.default_rng(42)
+    G_1 = rng.integers(0, 3, size=(3, 2492)).astype(np.float64)
+    G_1[2] = 0
+    G_2 = rng.integers(0, 3, size=(3, 500)).astype(np.float64)
+    G_2[2] = 0
+    G_2[2, :50] = 1
+    mean, std = _pooled_mnsd(G_1.mean(axis=1), G_1.var(axis=1), 2492, G_2.mean(axis=1), G_2.var(axis=1), 500)
+    G = np.hstack((G_1, G_2))
+    np.testing.assert_allclose(mean, G.mean(axis=1))
+    np.testing.assert_allclose(std, G.std(axis=1))
+
+
+def test_svd_update():
+    """ Updating a thin SVD matches the SVD of the updated matrix """
+    rng = np.random.default_rng(42)
+    X = rng.normal(size=(50, 5)) @ rng.normal(size=(5, 30))
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+    A, B = rng.normal(size=(50, 2)), rng.normal(size=(30, 2))
+    U2, s2, V2 = svd_update(U[:, :5], s[:5], Vt[:5].T, A, B, l=7)
+    np.testing.assert_allclose(U2 @ np.diag(s2) @ V2.T, X + A @ B.T, atol=1e-8)
+    np.testing.assert_allclose(s2, np.linalg.svd(X + A @ B.T, compute_uv=False)[:7], atol=1e-8)
+
+
+def test_oadp():
+    """ OADP in the coordinates of the reference PCs matches the online SVD on the augmented reference """
+    rng = np.random.default_rng(42)
+    X = rng.normal(size=(500, 60))
+    X[:, :30] += rng.normal(size=(500, 1))
+    X -= X.mean(axis=1, keepdims=True)
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+    b = X[:, 0] + rng.normal(size=500)
+    s_aug, V_aug = svd_online(U[:, :16], s[:16], Vt[:16].T, b)
+    expected = ref_aug_procrustes(Vt[:4].T * s[:4], V_aug[:, :8] * s_aug[:8])[:4]
+    np.testing.assert_allclose(oadp(U, s, Vt.T, b, dim_ref=4, dim_stu=8, dim_online=16), expected, atol=1e-8)
+
+
+def test_packed_genotypes(ref_data):
+    """ Packed genotypes unpack to the genotypes read by read_bed and have the same mean/std as standardize """
+    G, bim, fam = read_bed(str(ref_data / "example_comm"))
+    packed = open_bed(str(ref_data / "example_comm"), len(bim), len(fam))
+    np.testing.assert_array_equal(packed.load().unpack(), G)
+    idx = np.array([1, 2, 7, 30, 31, 32, 499])
+    np.testing.assert_array_equal(packed.take_samples(idx).unpack(), G[:, idx])
+    np.testing.assert_array_equal(packed.take_samples(np.arange(8, 101)).unpack(slice(5, 50), slice(3, 70)),
+                                  G[5:50, 11:78])
+    np.testing.assert_array_equal(PackedGenotypes.from_array(G[:, idx]).unpack(), G[:, idx])
+    np.testing.assert_array_equal(packed.n_missing, np.sum(G == 3, axis=1))
+    mean, std = standardize(G.astype(np.float64))
+    packed_mean, packed_std = packed.mean_std()
+    np.testing.assert_allclose(packed_mean, mean)
+    np.testing.assert_allclose(packed_std, std)
+
+
+def test_prefetch():
+    """ Prefetched items arrive in order and errors in the background thread reach the consumer """
+    assert list(prefetch(iter(range(10)), depth=2)) == list(range(10))
+
+    def failing():
+        yield 1
+        raise ValueError("bad chunk")
+
+    with pytest.raises(ValueError, match="bad chunk"):
+        list(prefetch(failing()))
+
+
 def _fraposa_finished(ref_data, stu_prefix="example_comm"):
     fn = ref_data / f"{stu_prefix}.log"
     with open(fn, 'r') as f: